@@ -1,8 +1,9 @@
 import pickle
 import socket
-from typing import Tuple
 
+from codec import *
 from model import *
+from protocol import *
 
 
 def is_valid_input(square_name: str):
@@ -37,41 +38,34 @@ def display(game, color):
         print()
 
 
-def send(sock: socket.socket, data: bytes, type_=""):
-    header = {
-        "type": type_,
-        "length": len(data)
-    }
-
-    pickled_header = pickle.dumps(header)
-    pickled_header += b' ' * (HEADER - len(pickled_header))
-
-    sock.sendall(pickled_header)
-    sock.sendall(data)
-
-
-def recv(sock: socket.socket) -> Tuple[bytes, str]:
-    pickled_header = b''
-    received_length = 0
-
-    while HEADER - received_length > 0:
-        pickled_header += sock.recv(HEADER - received_length)
-        received_length = len(pickled_header)
-
-    header = pickle.loads(pickled_header)
-    data_len = header["length"]
-    data_type = header["type"]
-    received_length = 0
-
-    chunks = []
-    while data_len - received_length > 0:
-        chunk = sock.recv(data_len - received_length)
-        chunks.append(chunk)
-        received_length += len(chunk)
-
-    data = b''.join(chunks)
-
-    return data, data_type
+def watch(s):
+    # Spectators are sent each game from its start and every move after, until the room closes
+    game = None
+    while True:
+        try:
+            data, datatype = recv(s)
+        except ConnectionError:
+            print("The room has closed")
+            return
+
+        if datatype == "watch_start":
+            game, white_username, black_username = decode_watch_start(data)
+            print(f"{white_username} (WHITE) vs {black_username} (BLACK)")
+        elif datatype == "delta":
+            game, _ = apply_move_delta(game, data)
+        elif datatype == "game_over":
+            _, reason = decode_game_over(data)
+            print("-" * 3, "GAME OVER", "-" * 3)
+            print(reason)
+            continue
+        else:
+            continue
+
+        turn_color = "WHITE" if game.turn == WHITE else "BLACK"
+        print("-" * 5, turn_color, "-" * 5)
+        display(game, "WHITE")
+        if game.moves and game.moves[-1].check:
+            print("Check!")
 
 
 def main():
@@ -84,9 +78,10 @@ def main():
         send(s, bytes(player_name, "utf-8"))
 
         response = ""
-        while response.lower() not in ["create", "join"]:
-            response = input("Enter whether you want to join or create a room [join, create]: ")
+        while response.lower() not in ["create", "join", "bot", "watch"]:
+            response = input("Enter whether you want to join or create a room, play the computer, or watch a game [join, create, bot, watch]: ")
 
+        action = response.lower()
         send(s, bytes(response, "utf-8"))
 
         if response.lower() == "create":
@@ -95,7 +90,7 @@ def main():
             msg = msg.decode("utf-8")
             print(msg)
             print("Waiting for someone to join...")
-        elif response.lower() == "join":
+        elif response.lower() in ["join", "watch"]:
             valid_room_code = False
             while not valid_room_code:
                 response = input("Enter your room code: ")
@@ -118,6 +113,10 @@ def main():
         msg = msg.decode("utf-8")
         print(msg)
 
+        if action == "watch":
+            watch(s)
+            return
+
         in_room = True
         while in_room:
             # catch sending of opponent name
@@ -125,13 +124,14 @@ def main():
             in_game = True
             while in_game:
                 data, datatype = recv(s)
-                if datatype == "gamestate":
-                    game_state = pickle.loads(data)
-                    in_game = game_state["in_game"]
-                    game = game_state["game"]
-                    my_color = game_state["player_color"]
-                    turn_color = game_state["turn_color"]
-                    turn = -1 if turn_color == "WHITE" else 1
+                if datatype == "game_start":
+                    game, my_color_int = decode_game_start(data)
+                    my_color = "WHITE" if my_color_int == WHITE else "BLACK"
+                elif datatype == "delta":
+                    game, in_game = apply_move_delta(game, data)
+                elif datatype == "move_error":
+                    game, reason = apply_move_error(game, data)
+                    print(MOVE_ERROR_MESSAGES.get(reason, "The server rejected that move"))
                 elif datatype == "resign":
                     # Added for compatibility with GUI version. This is the only feature that would affect the TUI client
                     display(game, my_color)
@@ -139,20 +139,29 @@ def main():
                     in_game = False
                     continue
 
-                if game.check_if_game_ended() == CHECKMATE:
+                turn = game.turn
+                turn_color = "WHITE" if turn == WHITE else "BLACK"
+
+                result = game.check_if_game_ended()
+                if result == CHECKMATE:
                     print("-" * 3, "GAME OVER", "-" * 3)
                     display(game, my_color)
                     print(f"Checkmate! You lost!")
                     in_game = False
                     continue
-                elif game.check_if_game_ended() == STALEMATE:
+                elif result in DRAW_MESSAGES:
                     print("-" * 3, "GAME OVER", "-" * 3)
                     display(game, my_color)
-                    print("Stalemate!")
+                    print(DRAW_MESSAGES[result])
                     in_game = False
                     continue
-                elif game.is_targeted(BLACK, game.board.white_king.square, check_if_exposes_king=False) or \
-                        game.is_targeted(WHITE, game.board.black_king.square, check_if_exposes_king=False):
+                elif not in_game:
+                    # The server has ended the game, which is what counts even if this board does not show why
+                    print("-" * 3, "GAME OVER", "-" * 3)
+                    display(game, my_color)
+                    print("The game is over!")
+                    continue
+                elif game.is_in_check():
                     print("-" * 5, turn_color, "-" * 5)
                     display(game, my_color)
                     print("Check!")
@@ -212,6 +221,7 @@ def main():
                                 final_loc=square_to_move_to,
                                 piece_moved=game.board.get(square_to_move_from),
                                 piece_captured=game.board.get(square_to_move_to),
+                                promotion=promotion_val
                             )
                             move = game.correct_en_passant(move)
                             move_success = game.is_move_legal(move)
@@ -221,21 +231,22 @@ def main():
 
                     print()
 
-                    if game.check_if_game_ended() == CHECKMATE:
+                    result = game.check_if_game_ended()
+                    if result == CHECKMATE:
                         print("-" * 3, "GAME OVER", "-" * 3)
                         display(game, my_color)
                         print(f"Checkmate! You won!")
                         in_game = False
-                    elif game.check_if_game_ended() == STALEMATE:
+                    elif result in DRAW_MESSAGES:
                         print("-" * 3, "GAME OVER", "-" * 3)
                         display(game, my_color)
-                        print("Stalemate!")
+                        print(DRAW_MESSAGES[result])
                         in_game = False
 
                     send(s, bytes(square_to_move_from + square_to_move_to + str(promotion_val), "utf-8"), type_="move")
 
-                    if game.check_if_game_ended():
-                        # Server about to send game state again, but it is unnecessary
+                    if result:
+                        # Server about to echo the final move, but it is unnecessary
                         _ = recv(s)
 
             response = input("Rematch [y, N]: ")
@@ -256,7 +267,6 @@ def main():
 
 
 if __name__ == '__main__':
-    HEADER = 64
     SERVER = socket.gethostname()
     PORT = 55555
     main()
@@ -1,14 +1,16 @@
 import os
 import pickle
+import queue
 import socket
 import sys
 import threading
-from typing import Tuple
 
 import pygame as pg
 import select
 
+from codec import *
 from model import *
+from protocol import *
 
 
 def is_valid_input(square_name: str):
@@ -65,9 +67,9 @@ def draw_move_list(x, y, width, height, win, game):
                 pg.draw.rect(win, (50, 50, 50), rect)
 
             win.blit(font.render(f"{i + 1 + MOVE_LIST_SCROLL}. ", True, (200, 200, 200)), (x + 10, y + 3 + MOVE_LIST_LINE_HEIGHT * i))
-            win.blit(font.render(group[0].to_algebraic_notation(), True, (200, 200, 200)), (x + 50, y + 3 + MOVE_LIST_LINE_HEIGHT * i))
+            win.blit(font.render(group[0].san, True, (200, 200, 200)), (x + 50, y + 3 + MOVE_LIST_LINE_HEIGHT * i))
             if len(group) == 2:
-                win.blit(font.render(group[1].to_algebraic_notation(), True, (200, 200, 200)), (x + 150, y + 3 + MOVE_LIST_LINE_HEIGHT * i))
+                win.blit(font.render(group[1].san, True, (200, 200, 200)), (x + 150, y + 3 + MOVE_LIST_LINE_HEIGHT * i))
 
 
 def draw_one_box_draw_button(x, y, width, height, win):
@@ -150,43 +152,6 @@ def render(win, game, perspective=WHITE):
     pg.display.update()
 
 
-def send(sock: socket.socket, data: bytes, type_=""):
-    header = {
-        "type": type_,
-        "length": len(data)
-    }
-
-    pickled_header = pickle.dumps(header)
-    pickled_header += b' ' * (HEADER - len(pickled_header))
-
-    sock.sendall(pickled_header)
-    sock.sendall(data)
-
-
-def recv(sock: socket.socket) -> Tuple[bytes, str]:
-    pickled_header = b''
-    received_length = 0
-
-    while HEADER - received_length > 0:
-        pickled_header += sock.recv(HEADER - received_length)
-        received_length = len(pickled_header)
-
-    header = pickle.loads(pickled_header)
-    data_len = header["length"]
-    data_type = header["type"]
-    received_length = 0
-
-    chunks = []
-    while data_len - received_length > 0:
-        chunk = sock.recv(data_len - received_length)
-        chunks.append(chunk)
-        received_length += len(chunk)
-
-    data = b''.join(chunks)
-
-    return data, data_type
-
-
 def update_from_server(sock: socket.socket):
     global game, my_color, turn_color, turn, my_color_int, DRAW_STATE, RESIGN_STATE, OPP_NAME
     in_game = True
@@ -195,15 +160,18 @@ def update_from_server(sock: socket.socket):
 
         if readable:
             data, data_type = recv(sock)
-            if data_type == "gamestate":
-                game_state = pickle.loads(data)
-                in_game = game_state["in_game"]
-                game = game_state["game"]
-                my_color = game_state["player_color"]
-                turn_color = game_state["turn_color"]
-
-                turn = -1 if turn_color == "WHITE" else 1
-                my_color_int = -1 if my_color == "WHITE" else 1
+            if data_type == "game_start":
+                game, my_color_int = decode_game_start(data)
+                my_color = "WHITE" if my_color_int == WHITE else "BLACK"
+
+                turn = game.turn
+                turn_color = "WHITE" if turn == WHITE else "BLACK"
+            elif data_type == "delta":
+                # Applied by the main loop, which is also reading and moving on the board
+                in_game = decode_move_delta(data)[2]
+                pending_updates.put((data_type, data))
+            elif data_type == "move_error":
+                pending_updates.put((data_type, data))
             elif data_type == "draw_offer":
                 DRAW_STATE = 1
             elif data_type == "draw_accept":
@@ -229,8 +197,8 @@ def main():
         send(s, bytes(PLAYER_NAME, "utf-8"))
 
         response = ""
-        while response.lower() not in ["create", "join"]:
-            response = input("Enter whether you want to join or create a room [join, create]: ")
+        while response.lower() not in ["create", "join", "bot"]:
+            response = input("Enter whether you want to join or create a room, or play the computer [join, create, bot]: ")
 
         send(s, bytes(response, "utf-8"))
 
@@ -277,14 +245,29 @@ def main():
             while in_game:
                 global game, my_color, turn_color, turn, my_color_int, square_to_move_from, square_to_move_to, promotion_value, move_in_progress, MOVE_LIST_SCROLL, DRAW_STATE, RESIGN_STATE
 
+                while not pending_updates.empty():
+                    update_type, update = pending_updates.get()
+                    if update_type == "delta":
+                        game, in_game = apply_move_delta(game, update, notate=True)
+                    else:
+                        game, reason = apply_move_error(game, update)
+                        print(MOVE_ERROR_MESSAGES.get(reason, "The server rejected that move"))
+                    turn = game.turn
+                    turn_color = "WHITE" if turn == WHITE else "BLACK"
+
                 render(win, game, perspective=my_color_int)
                 pg.display.set_caption(f"Chess [{turn_color}]")
 
-                if game.check_if_game_ended() == CHECKMATE:
+                result = game.check_if_game_ended()
+                if result == CHECKMATE:
                     print(f"Checkmate! You lost!")
                     break
-                elif game.check_if_game_ended() == STALEMATE:
-                    print("Stalemate!")
+                elif result in DRAW_MESSAGES:
+                    print(DRAW_MESSAGES[result])
+                    break
+                elif not in_game:
+                    # The server has ended the game, which is what counts even if this board does not show why
+                    print("The game is over!")
                     break
                 elif DRAW_STATE == 2:
                     print("Draw!")
@@ -389,25 +372,22 @@ def main():
                     move_success = game.is_move_legal(move)
 
                     if move_success:
-                        game.move(move)
+                        game.make_notated_move(move.to_packed())
                         if (len(game.moves) - 2 * MOVE_LIST_SCROLL) / 2 > NUM_TURNS_IN_MOVE_LIST:
                             MOVE_LIST_SCROLL += 1
 
                         move_in_progress = True
 
-                        if game.check_if_game_ended() == CHECKMATE:
+                        result = game.check_if_game_ended()
+                        if result == CHECKMATE:
                             print(f'Checkmate! {"WHITE" if turn == WHITE else "BLACK"} won!')
                             game.moves[-1].mate = True
                             in_game = False
-                        elif game.check_if_game_ended() == STALEMATE:
-                            print("Stalemate!")
+                        elif result in DRAW_MESSAGES:
+                            print(DRAW_MESSAGES[result])
                             in_game = False
-                        elif turn == WHITE:
-                            if game.is_targeted(WHITE, game.board.black_king.square, check_if_exposes_king=False):
-                                game.moves[-1].check = True
-                        elif turn == BLACK:
-                            if game.is_targeted(BLACK, game.board.white_king.square, check_if_exposes_king=False):
-                                game.moves[-1].check = True
+                        elif game.is_in_check():
+                            game.moves[-1].check = True
 
                         render(win, game, perspective=my_color_int)
 
@@ -448,6 +428,8 @@ def main():
                 in_room = False
             else:
                 # Resetting in preparation for new game
+                while not pending_updates.empty():
+                    pending_updates.get()
                 game = Game()
                 my_color = None
                 turn_color = None
@@ -467,7 +449,6 @@ def rss_path(relative_path):
 
 
 if __name__ == '__main__':
-    HEADER = 64
     SERVER = socket.gethostname()
     PORT = 55555
 
@@ -528,4 +509,6 @@ if __name__ == '__main__':
 
     move_in_progress = False
 
+    pending_updates = queue.Queue()  # ("delta" or "move_error", data) from the server, applied by the main loop
+
     main()
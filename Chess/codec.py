@@ -0,0 +1,78 @@
+import socket
+import struct
+import threading
+from typing import Tuple
+
+# Every message is a frame header followed by its payload: magic, framing version, message type code, payload length
+FRAME_HEADER = struct.Struct("!2sBBI")
+FRAME_MAGIC = b"CH"
+FRAME_VERSION = 1
+MAX_FRAME_LENGTH = 1 << 20  # payloads are preallocated from the header, so a garbled length must not allocate gigabytes
+
+# Message types by code. Only ever append, so that codes keep their meaning
+MESSAGE_TYPES = ["", "move", "delta", "game_start", "move_error", "opp_name", "draw_offer", "draw_accept", "draw_reject",
+                 "resign", "watch_start", "game_over"]
+MESSAGE_TYPE_CODES = {type_: code for code, type_ in enumerate(MESSAGE_TYPES)}
+
+# Header buffer of each thread, which is reused for every message it reads, since a thread reads one at a time
+header_buffers = threading.local()
+
+
+class FrameError(ConnectionError):
+    # The stream no longer lines up with frame boundaries, so the connection is as good as closed
+    pass
+
+
+def pack_header(length, type_=""):
+    return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, MESSAGE_TYPE_CODES[type_], length)
+
+
+def unpack_header(header) -> Tuple[int, str]:
+    magic, version, type_code, length = FRAME_HEADER.unpack(header)
+    if magic != FRAME_MAGIC:
+        raise FrameError("Not a message frame")
+    if version != FRAME_VERSION:
+        raise FrameError(f"Unsupported framing version {version}, expected {FRAME_VERSION}")
+    if type_code >= len(MESSAGE_TYPES):
+        raise FrameError(f"Unknown message type {type_code}")
+    if length > MAX_FRAME_LENGTH:
+        raise FrameError(f"Message of {length} bytes is too long")
+
+    return length, MESSAGE_TYPES[type_code]
+
+
+def pack_message(data: bytes, type_=""):
+    # Header and payload go out in one write, so small messages are not held back waiting for the ack of the header
+    return pack_header(len(data), type_) + data
+
+
+def frame_type(frame: bytes) -> str:
+    # Type of a frame packed by pack_message
+    return MESSAGE_TYPES[FRAME_HEADER.unpack_from(frame)[2]]
+
+
+def send(sock: socket.socket, data: bytes, type_=""):
+    sock.sendall(pack_message(data, type_))
+
+
+def recv_exactly_into(sock: socket.socket, buffer):
+    view = memoryview(buffer)
+    while view:
+        received = sock.recv_into(view)
+        if not received:
+            raise ConnectionError("Connection closed")
+        view = view[received:]
+
+
+def recv(sock: socket.socket) -> Tuple[bytearray, str]:
+    header = getattr(header_buffers, "header", None)
+    if header is None:
+        header = header_buffers.header = bytearray(FRAME_HEADER.size)
+    recv_exactly_into(sock, header)
+    length, type_ = unpack_header(header)
+
+    # The payload is handed over as read, so it is the one buffer allocated for each message
+    data = bytearray(length)
+    recv_exactly_into(sock, data)
+
+    return data, type_
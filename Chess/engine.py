@@ -0,0 +1,302 @@
+import argparse
+import time
+
+from model import *
+from transposition import *
+
+PIECE_VALUES = [100, 320, 330, 500, 900, 0]
+MATE_SCORE = 100000
+INFINITY = 1000000
+
+# Piece-square bonuses from white's point of view, indexed by square index (a8 = 0, h1 = 63). Black uses index ^ 56
+PAWN_TABLE = [
+    0, 0, 0, 0, 0, 0, 0, 0,
+    50, 50, 50, 50, 50, 50, 50, 50,
+    10, 10, 20, 30, 30, 20, 10, 10,
+    5, 5, 10, 25, 25, 10, 5, 5,
+    0, 0, 0, 20, 20, 0, 0, 0,
+    5, -5, -10, 0, 0, -10, -5, 5,
+    5, 10, 10, -20, -20, 10, 10, 5,
+    0, 0, 0, 0, 0, 0, 0, 0,
+]
+KNIGHT_TABLE = [
+    -50, -40, -30, -30, -30, -30, -40, -50,
+    -40, -20, 0, 0, 0, 0, -20, -40,
+    -30, 0, 10, 15, 15, 10, 0, -30,
+    -30, 5, 15, 20, 20, 15, 5, -30,
+    -30, 0, 15, 20, 20, 15, 0, -30,
+    -30, 5, 10, 15, 15, 10, 5, -30,
+    -40, -20, 0, 5, 5, 0, -20, -40,
+    -50, -40, -30, -30, -30, -30, -40, -50,
+]
+BISHOP_TABLE = [
+    -20, -10, -10, -10, -10, -10, -10, -20,
+    -10, 0, 0, 0, 0, 0, 0, -10,
+    -10, 0, 5, 10, 10, 5, 0, -10,
+    -10, 5, 5, 10, 10, 5, 5, -10,
+    -10, 0, 10, 10, 10, 10, 0, -10,
+    -10, 10, 10, 10, 10, 10, 10, -10,
+    -10, 5, 0, 0, 0, 0, 5, -10,
+    -20, -10, -10, -10, -10, -10, -10, -20,
+]
+ROOK_TABLE = [
+    0, 0, 0, 0, 0, 0, 0, 0,
+    5, 10, 10, 10, 10, 10, 10, 5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    0, 0, 0, 5, 5, 0, 0, 0,
+]
+QUEEN_TABLE = [
+    -20, -10, -10, -5, -5, -10, -10, -20,
+    -10, 0, 0, 0, 0, 0, 0, -10,
+    -10, 0, 5, 5, 5, 5, 0, -10,
+    -5, 0, 5, 5, 5, 5, 0, -5,
+    0, 0, 5, 5, 5, 5, 0, -5,
+    -10, 5, 5, 5, 5, 5, 0, -10,
+    -10, 0, 5, 0, 0, 0, 0, -10,
+    -20, -10, -10, -5, -5, -10, -10, -20,
+]
+KING_TABLE = [
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -20, -30, -30, -40, -40, -30, -30, -20,
+    -10, -20, -20, -20, -20, -20, -20, -10,
+    20, 20, 0, 0, 0, 0, 20, 20,
+    20, 30, 10, 0, 0, 10, 30, 20,
+]
+PIECE_SQUARE_TABLES = [PAWN_TABLE, KNIGHT_TABLE, BISHOP_TABLE, ROOK_TABLE, QUEEN_TABLE, KING_TABLE]
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+def evaluate(game: Game):
+    # Score from the point of view of the side to move
+    score = 0
+    for color in [WHITE, BLACK]:
+        sign = 1 if color == game.turn else -1
+        flip = 0 if color == WHITE else 56
+        for piece_type, bb in enumerate(game.board.bitboard.pieces[color]):
+            table = PIECE_SQUARE_TABLES[piece_type]
+            for index in bit_indices(bb):
+                score += sign * (PIECE_VALUES[piece_type] + table[index ^ flip])
+
+    return score
+
+
+def score_to_table(score, ply):
+    # Mate scores are stored relative to the stored position rather than the root
+    if score >= MATE_SCORE - 1000:
+        return score + ply
+    if score <= -MATE_SCORE + 1000:
+        return score - ply
+    return score
+
+
+def score_from_table(score, ply):
+    if score >= MATE_SCORE - 1000:
+        return score - ply
+    if score <= -MATE_SCORE + 1000:
+        return score + ply
+    return score
+
+
+class Engine:
+    def __init__(self, time_limit=1.0, max_depth=64, table_size_mb=16):
+        self.time_limit = time_limit
+        self.max_depth = max_depth
+        self.table = TranspositionTable(table_size_mb)
+
+        self.killers = [[0, 0] for _ in range(max_depth + 1)]
+        self.history = {WHITE: [[0] * 64 for _ in range(64)], BLACK: [[0] * 64 for _ in range(64)]}
+
+        self.nodes = 0
+        self.depth_reached = 0
+        self.elapsed = 0
+        self.score = 0
+        self.deadline = 0
+        self.principal_move = 0  # best move of the last completed iteration, packed
+        self.undo_stack = []
+
+    @property
+    def nodes_per_second(self):
+        return self.nodes / self.elapsed if self.elapsed > 0 else 0
+
+    def order_moves(self, game: Game, moves, ply, best=0):
+        killers = self.killers[ply] if ply < len(self.killers) else [0, 0]
+        history = self.history[game.turn]
+        board = game.board.board
+
+        def priority(move):
+            if move == best:
+                return 10000000
+            initial_index, final_index, flags = unpack_move(move)
+            if flags & CAPTURE:
+                # MVV-LVA: most valuable victim first, least valuable attacker breaking ties
+                victim = PAWN if flags == EN_PASSANT_CAPTURE else board[SQUARES[final_index]].piece_type
+                return 1000000 + 10 * PIECE_VALUES[victim] - board[SQUARES[initial_index]].piece_type
+            if flags & PROMOTION:
+                return 900000 + PIECE_VALUES[packed_promotion(move)]
+            if move == killers[0]:
+                return 800000
+            if move == killers[1]:
+                return 700000
+            return history[initial_index][final_index]
+
+        return sorted(moves, key=priority, reverse=True)
+
+    def is_in_check(self, game: Game):
+        king = game.board.white_king if game.turn == WHITE else game.board.black_king
+        return game.is_targeted(-game.turn, king.square, check_if_exposes_king=False)
+
+    def make_move(self, game: Game, move):
+        self.undo_stack.append(game.make_packed_move(move))
+
+    def unmake_move(self, game: Game):
+        game.unmake_move(self.undo_stack.pop())
+
+    def check_time(self):
+        if self.nodes & 1023 == 0 and time.perf_counter() > self.deadline:
+            raise SearchTimeout()
+
+    def quiescence(self, game: Game, alpha, beta, ply):
+        self.nodes += 1
+        self.check_time()
+
+        stand_pat = evaluate(game)
+        if stand_pat >= beta:
+            return stand_pat
+        if stand_pat > alpha:
+            alpha = stand_pat
+
+        captures = [move for move in game.generate_packed_moves_for(game.turn) if is_packed_capture(move) or packed_promotion(move) == QUEEN]
+        for move in self.order_moves(game, captures, ply):
+            self.make_move(game, move)
+            score = -self.quiescence(game, -beta, -alpha, ply + 1)
+            self.unmake_move(game)
+
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+
+        return alpha
+
+    def negamax(self, game: Game, depth, alpha, beta, ply):
+        if depth <= 0:
+            return self.quiescence(game, alpha, beta, ply), 0
+
+        self.nodes += 1
+        self.check_time()
+
+        position_key = game.board.zobrist_key
+        if ply > 0 and (game.position_counts[position_key] > 1 or game.board.halfmove_clock >= 100):
+            # Coming back to a position heads for a draw by repetition, and the fifty-move rule is a draw already
+            return 0, 0
+
+        entry = self.table.probe(position_key)
+        hash_move = 0
+        if entry:
+            entry_depth, bound, score, hash_move = entry
+            if ply > 0 and entry_depth >= depth:
+                score = score_from_table(score, ply)
+                if bound == EXACT or (bound == LOWER_BOUND and score >= beta) or (bound == UPPER_BOUND and score <= alpha):
+                    return score, 0
+
+        moves = game.generate_packed_moves_for(game.turn)
+        if not moves:
+            if self.is_in_check(game):
+                return -MATE_SCORE + ply, 0
+            return 0, 0
+
+        if ply == 0 and self.principal_move:
+            hash_move = self.principal_move
+
+        original_alpha = alpha
+        best_score = -INFINITY
+        best_move = 0
+        for move in self.order_moves(game, moves, ply, hash_move):
+            self.make_move(game, move)
+            score = -self.negamax(game, depth - 1, -beta, -alpha, ply + 1)[0]
+            self.unmake_move(game)
+
+            if score > best_score:
+                best_score = score
+                best_move = move
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                if not is_packed_capture(move) and ply < len(self.killers):
+                    if self.killers[ply][0] != move:
+                        self.killers[ply][1] = self.killers[ply][0]
+                        self.killers[ply][0] = move
+                    initial_index, final_index, _ = unpack_move(move)
+                    self.history[game.turn][initial_index][final_index] += depth * depth
+                break
+
+        if best_score <= original_alpha:
+            bound = UPPER_BOUND
+        elif best_score >= beta:
+            bound = LOWER_BOUND
+        else:
+            bound = EXACT
+        self.table.store(position_key, depth, score_to_table(best_score, ply), bound, best_move)
+
+        return best_score, best_move
+
+    def search(self, game: Game, time_limit=None):
+        start = time.perf_counter()
+        self.deadline = start + (self.time_limit if time_limit is None else time_limit)
+        self.nodes = 0
+        self.depth_reached = 0
+        self.principal_move = 0
+        self.table.new_search()
+
+        for depth in range(1, self.max_depth + 1):
+            try:
+                score, move = self.negamax(game, depth, -INFINITY, INFINITY, 0)
+            except SearchTimeout:
+                # unwind the moves the interrupted search still had on the board
+                while self.undo_stack:
+                    self.unmake_move(game)
+                break
+
+            if move == 0:
+                break
+
+            self.principal_move = move
+            self.score = score
+            self.depth_reached = depth
+
+            if abs(score) >= MATE_SCORE - self.max_depth:
+                break
+
+        if self.principal_move == 0:
+            moves = game.generate_packed_moves_for(game.turn)
+            if moves:
+                self.principal_move = self.order_moves(game, moves, 0)[0]
+
+        self.elapsed = time.perf_counter() - start
+
+        return Move.from_packed(self.principal_move, game.board) if self.principal_move else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search the starting position and report search speed")
+    parser.add_argument("--time", type=float, default=5.0, help="seconds to search")
+    args = parser.parse_args()
+
+    engine = Engine(time_limit=args.time)
+    move = engine.search(Game())
+    print(f"Best move: {move.to_algebraic_notation()}")
+    print(f"Depth: {engine.depth_reached}; Score: {engine.score}; Nodes: {engine.nodes}; Time: {engine.elapsed:.2f}s; Nodes/s: {engine.nodes_per_second:,.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+import argparse
+import asyncio
+import multiprocessing
+import random
+import re
+import time
+from collections import Counter
+
+from codec import *
+from model import *
+from protocol import *
+
+
+class Stats:
+    def __init__(self):
+        self.round_trips = []  # seconds from sending a move to receiving the server's delta for it
+        self.moves = 0
+        self.games = 0
+        self.errors = Counter()
+
+    def merge(self, other):
+        self.round_trips += other.round_trips
+        self.moves += other.moves
+        self.games += other.games
+        self.errors += other.errors
+
+
+async def send_message(writer: asyncio.StreamWriter, data: bytes, type_=""):
+    writer.write(pack_message(data, type_))
+    await writer.drain()
+
+
+async def recv_message(reader: asyncio.StreamReader, timeout):
+    length, type_ = unpack_header(await asyncio.wait_for(reader.readexactly(FRAME_HEADER.size), timeout))
+    data = await asyncio.wait_for(reader.readexactly(length), timeout)
+
+    return data, type_
+
+
+async def play(reader, writer, stats: Stats, options, rng: random.Random, counts_games):
+    """Play options.games games as one side of a room with random legal moves, the way client.py talks to the server"""
+    for game_number in range(options.games):
+        await recv_message(reader, options.timeout)  # opponent's name
+
+        game = None
+        color = None
+        in_game = True
+        sent_at = None
+        while in_game:
+            data, data_type = await recv_message(reader, options.timeout)
+            if data_type == "game_start":
+                game, color = decode_game_start(data)
+            elif data_type == "delta":
+                game, in_game = apply_move_delta(game, data)
+                if sent_at is not None:
+                    # Nothing else can be played while it is our move, so this is the delta for the move we sent
+                    stats.round_trips.append(time.perf_counter() - sent_at)
+                    stats.moves += 1
+                    sent_at = None
+            elif data_type == "move_error":
+                game, reason = apply_move_error(game, data)
+                stats.errors[f"move rejected: {MOVE_ERROR_MESSAGES.get(reason, reason)}"] += 1
+                sent_at = None
+            elif data_type == "resign":
+                break
+            else:
+                stats.errors[f"unexpected {data_type or 'text'} message"] += 1
+                continue
+
+            if in_game and game.turn == color:
+                if len(game.moves) >= options.moves:
+                    await send_message(writer, bytes("resign", "utf-8"), type_="resign")
+                    break
+
+                if options.delay:
+                    await asyncio.sleep(options.delay)
+
+                move = rng.choice(game.get_legal_moves())
+                move_string = move.initial_loc.convert_to_name() + move.final_loc.convert_to_name() + str(move.promotion)
+                sent_at = time.perf_counter()
+                await send_message(writer, bytes(move_string, "utf-8"), type_="move")
+
+        if counts_games:
+            stats.games += 1
+
+        await send_message(writer, bytes("y" if game_number + 1 < options.games else "n", "utf-8"))
+
+        # Rematch decision
+        data, data_type = await recv_message(reader, options.timeout)
+        while data_type != "":
+            data, data_type = await recv_message(reader, options.timeout)
+        if data.decode("utf-8") == "Rematch denied!":
+            break
+
+
+async def open_player(options, username, action):
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(options.host, options.port), options.timeout)
+    await send_message(writer, bytes(username, "utf-8"))
+    await send_message(writer, bytes(action, "utf-8"))
+
+    return reader, writer
+
+
+async def run_room(number, options, stats: Stats, rng: random.Random):
+    writers = []
+    try:
+        host_reader, host_writer = await open_player(options, f"load-{number}-host", "create")
+        writers.append(host_writer)
+        code_message, _ = await recv_message(host_reader, options.timeout)
+        code = re.search(r"\d+", code_message.decode("utf-8"))
+        if code is None:
+            stats.errors[f"no room: {code_message.decode('utf-8')}"] += 1
+            return
+
+        guest_reader, guest_writer = await open_player(options, f"load-{number}-guest", "join")
+        writers.append(guest_writer)
+        await send_message(guest_writer, bytes(code.group(), "utf-8"))
+
+        # Messages stating that someone/you joined the room
+        await recv_message(host_reader, options.timeout)
+        await recv_message(guest_reader, options.timeout)
+
+        await asyncio.gather(play(host_reader, host_writer, stats, options, rng, True),
+                             play(guest_reader, guest_writer, stats, options, rng, False))
+    except asyncio.TimeoutError:
+        stats.errors["timed out"] += 1
+    except FrameError:
+        stats.errors["bad frame"] += 1
+    except (ConnectionError, asyncio.IncompleteReadError, OSError):
+        stats.errors["disconnected"] += 1
+    except ProtocolError:
+        stats.errors["out of step with the server"] += 1
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+async def run_rooms(first_room, count, options, seed):
+    stats = Stats()
+    rng = random.Random(seed)
+
+    async def start_room(number):
+        # Rooms are started evenly over the ramp, so that the server is not hit by every connection at once
+        await asyncio.sleep(options.ramp * number / options.rooms)
+        await run_room(number, options, stats, rng)
+
+    await asyncio.gather(*(start_room(number) for number in range(first_room, first_room + count)))
+    return stats
+
+
+def run_process(first_room, count, options, seed):
+    return asyncio.run(run_rooms(first_room, count, options, seed))
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def report(stats: Stats, elapsed, rooms):
+    print(f"Rooms: {rooms}; Games: {stats.games}; Moves: {stats.moves}; Time: {elapsed:.2f}s "
+          f"({stats.moves / max(elapsed, 1e-9):,.0f} moves/s)")
+
+    if stats.round_trips:
+        round_trips = sorted(stats.round_trips)
+        print(f"Move round trip: p50 {percentile(round_trips, 0.5) * 1000:.2f} ms; "
+              f"p99 {percentile(round_trips, 0.99) * 1000:.2f} ms; max {round_trips[-1] * 1000:.2f} ms")
+
+    if stats.errors:
+        print(f"Errors: {sum(stats.errors.values())}")
+        for error, count in stats.errors.most_common():
+            print(f"  {error}: {count}")
+    else:
+        print("Errors: 0")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load the Chess server with rooms of clients playing random legal moves")
+    parser.add_argument("--host", default="127.0.0.1", help="server to connect to")
+    parser.add_argument("--port", type=int, default=55555, help="port the server listens on")
+    parser.add_argument("--rooms", type=int, default=100, help="rooms played at the same time, each with two clients")
+    parser.add_argument("--games", type=int, default=1, help="games played in each room, by accepting rematches")
+    parser.add_argument("--moves", type=int, default=100, help="moves after which the side to move resigns")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds each client waits before each of its moves")
+    parser.add_argument("--ramp", type=float, default=1.0, help="seconds over which the rooms are started")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds to wait for any message before giving up on a room")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="processes to spread the rooms across, so that the clients are not what runs out of CPU")
+    parser.add_argument("--seed", type=int, help="seed for the random moves")
+    options = parser.parse_args()
+
+    seed = options.seed if options.seed is not None else random.randrange(1 << 32)
+    processes = max(1, min(options.processes, options.rooms))
+
+    start = time.perf_counter()
+    if processes == 1:
+        stats = run_process(0, options.rooms, options, seed)
+    else:
+        shares = [options.rooms // processes + (shard < options.rooms % processes) for shard in range(processes)]
+        jobs = [(sum(shares[:shard]), shares[shard], options, seed + shard) for shard in range(processes)]
+        with multiprocessing.get_context("spawn").Pool(processes) as pool:
+            stats = Stats()
+            for process_stats in pool.starmap(run_process, jobs):
+                stats.merge(process_stats)
+    elapsed = time.perf_counter() - start
+
+    report(stats, elapsed, options.rooms)
+
+
+if __name__ == '__main__':
+    main()
@@ -67,11 +67,12 @@ def main():
 
         print()
 
-        if game.check_if_game_ended() == CHECKMATE:
+        result = game.check_if_game_ended()
+        if result == CHECKMATE:
             print(f"Checkmate! {color} won!")
             running = False
-        elif game.check_if_game_ended() == STALEMATE:
-            print("Stalemate!")
+        elif result in DRAW_MESSAGES:
+            print(DRAW_MESSAGES[result])
             running = False
 
         turn *= -1
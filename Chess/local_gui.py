@@ -61,9 +61,9 @@ def draw_move_list(x, y, width, height, win, game):
                 pg.draw.rect(win, (50, 50, 50), rect)
 
             win.blit(font.render(f"{i + 1 + MOVE_LIST_SCROLL}. ", True, (200, 200, 200)), (x + 10, y + 3 + MOVE_LIST_LINE_HEIGHT * i))
-            win.blit(font.render(group[0].to_algebraic_notation(), True, (200, 200, 200)), (x + 50, y + 3 + MOVE_LIST_LINE_HEIGHT * i))
+            win.blit(font.render(group[0].san, True, (200, 200, 200)), (x + 50, y + 3 + MOVE_LIST_LINE_HEIGHT * i))
             if len(group) == 2:
-                win.blit(font.render(group[1].to_algebraic_notation(), True, (200, 200, 200)), (x + 150, y + 3 + MOVE_LIST_LINE_HEIGHT * i))
+                win.blit(font.render(group[1].san, True, (200, 200, 200)), (x + 150, y + 3 + MOVE_LIST_LINE_HEIGHT * i))
 
 
 def draw_draw_button(x, y, width, height, win):
@@ -206,24 +206,21 @@ def main():
             move_success = game.is_move_legal(move)
 
             if move_success:
-                game.move(move)
+                game.make_notated_move(move.to_packed())
                 if (len(game.moves) - 2 * MOVE_LIST_SCROLL) / 2 > NUM_TURNS_IN_MOVE_LIST:
                     MOVE_LIST_SCROLL += 1
 
-                if game.check_if_game_ended() == CHECKMATE:
+                result = game.check_if_game_ended()
+                if result == CHECKMATE:
                     print(f'Checkmate! {"WHITE" if turn == WHITE else "BLACK"} won!')
                     game.moves[-1].mate = True
                     running = False
                     DRAW_OFFERED = False
-                elif game.check_if_game_ended() == STALEMATE:
-                    print("Stalemate!")
+                elif result in DRAW_MESSAGES:
+                    print(DRAW_MESSAGES[result])
                     running = False
-                elif turn == WHITE:
-                    if game.is_targeted(WHITE, game.board.black_king.square, check_if_exposes_king=False):
-                        game.moves[-1].check = True
-                elif turn == BLACK:
-                    if game.is_targeted(BLACK, game.board.white_king.square, check_if_exposes_king=False):
-                        game.moves[-1].check = True
+                elif game.is_in_check():
+                    game.moves[-1].check = True
 
                 turn *= -1
 
@@ -0,0 +1,113 @@
+import asyncio
+import bisect
+
+# Upper bounds in seconds, from a cached lookup up to a validation pool timing out
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one counts what is above every bucket
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metrics:
+    """Counters, gauges and histograms of one server process, written out in the Prometheus text format.
+
+    Each metric has at most one label, given as a plain value, so that recording one on the hot path costs a dictionary
+    lookup and an addition
+    """
+
+    def __init__(self):
+        self.kinds = {}  # name -> (kind, help, label name)
+        self.values = {}  # (name, label value) -> number for counters and gauges, Histogram for histograms
+        self.readers = {}  # (name, label value) -> function giving the value of a gauge when it is scraped
+
+    def describe(self, name, kind, help, label=None):
+        self.kinds[name] = (kind, help, label)
+
+    def inc(self, name, value=1, label_value=None):
+        # Also adds to gauges, which may go down
+        key = (name, label_value)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, label_value=None):
+        key = (name, label_value)
+        histogram = self.values.get(key)
+        if histogram is None:
+            histogram = self.values[key] = Histogram()
+        histogram.observe(value)
+
+    def read_gauge(self, name, read, label_value=None):
+        self.readers[(name, label_value)] = read
+
+    def render(self):
+        samples = {}
+        for (name, label_value), value in self.values.items():
+            samples.setdefault(name, []).append((label_value, value))
+        for (name, label_value), read in self.readers.items():
+            samples.setdefault(name, []).append((label_value, read()))
+
+        lines = []
+        for name, (kind, help, label) in self.kinds.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for label_value, value in sorted(samples.get(name, []), key=lambda sample: str(sample[0])):
+                labels = [] if label is None else [f'{label}="{escape_label(str(label_value))}"']
+                if kind == "histogram":
+                    cumulative = 0
+                    for bound, count in zip(value.buckets + ("+Inf",), value.counts):
+                        cumulative += count
+                        bucket_labels = labels + [f'le="{bound}"']
+                        lines.append(f"{name}_bucket{format_labels(bucket_labels)} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {value.sum}")
+                    lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+                else:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+async def serve_metrics(metrics: Metrics, port, host="127.0.0.1"):
+    """Answer HTTP requests for /metrics on host:port with metrics, for Prometheus or curl to scrape"""
+
+    async def answer(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            # The headers are not needed, but are read so that the client is not reset before it has the answer
+            while (await reader.readline()) not in [b"\r\n", b"\n", b""]:
+                pass
+
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", metrics.render()
+            else:
+                status, body = "404 Not Found", "Metrics are at /metrics\n"
+
+            body_bytes = bytes(body, "utf-8")
+            writer.write(bytes(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                               f"Content-Length: {len(body_bytes)}\r\n\r\n", "latin-1") + body_bytes)
+            await writer.drain()
+        except (ConnectionError, ValueError):
+            # ValueError is a request line too long to be one
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(answer, host, port)
+    async with server:
+        await server.serve_forever()
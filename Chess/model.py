@@ -1,4 +1,6 @@
-import copy
+import random
+import re
+from array import array
 
 import numpy as np
 
@@ -15,9 +17,56 @@ BLACK = 1
 STALEMATE = -1
 GAME_IN_PLAY = 0
 CHECKMATE = 1
+# Draws that end the game while the side to move still has legal moves. Like stalemate they are negative
+REPETITION = -2
+FIFTY_MOVE_RULE = -3
+INSUFFICIENT_MATERIAL = -4
+
+DRAW_MESSAGES = {
+    STALEMATE: "Stalemate!",
+    REPETITION: "Draw by threefold repetition!",
+    FIFTY_MOVE_RULE: "Draw by the fifty-move rule!",
+    INSUFFICIENT_MATERIAL: "Draw by insufficient material!",
+}
+
+# Packed moves are 16-bit integers: bits 0-5 initial square index, 6-11 final square index, 12-15 flags
+QUIET = 0
+DOUBLE_PAWN_PUSH = 1
+KING_CASTLE = 2
+QUEEN_CASTLE = 3
+CAPTURE = 4
+EN_PASSANT_CAPTURE = 5
+PROMOTION = 8  # promotions add the promoted piece minus KNIGHT to the flags, and CAPTURE when they capture
+
+STARTING_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+PIECE_LETTERS = "PNBRQK"
+# Piece, origin file, origin rank, destination and promotion of a move in standard algebraic notation, without castling
+SAN_PATTERN = re.compile(r"([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?")
+# Castling rights field of a FEN: "-", or the rights that are left in KQkq order
+FEN_CASTLING_PATTERN = re.compile(r"-|K?Q?k?q?")
+
+
+def pack_move(initial_index, final_index, flags=QUIET):
+    return initial_index | final_index << 6 | flags << 12
+
+
+def unpack_move(packed):
+    return packed & 63, packed >> 6 & 63, packed >> 12
+
+
+def packed_promotion(packed):
+    flags = packed >> 12
+    return KNIGHT + (flags & 3) if flags & PROMOTION else None
+
+
+def is_packed_capture(packed):
+    return bool(packed >> 12 & CAPTURE)
 
 
 class Piece:
+    __slots__ = ('piece_type', 'color', 'square', 'captured')
+
     def __init__(self, piece_type, color, square):
         self.piece_type = piece_type
         self.color = color
@@ -45,43 +94,59 @@ class Piece:
 
 
 class Square(tuple):
-    def __init__(self, tup):
-        self.row = tup[0]
-        self.col = tup[1]
-        self.coords = tup
+    # Squares are (row, col) tuples so they can index the numpy board directly. The 64 on-board squares are
+    # interned in SQUARES, so constructing or looking one up never allocates; off-board squares (from get_diff)
+    # are still created on demand so that is_valid can reject them
+    __slots__ = ()
+
+    def __new__(cls, tup):
+        row, col = tup
+        if 0 <= row < 8 and 0 <= col < 8:
+            return SQUARES[row * 8 + col]
+        return tuple.__new__(cls, (row, col))
+
+    @property
+    def row(self):
+        return self[0]
+
+    @property
+    def col(self):
+        return self[1]
+
+    @property
+    def coords(self):
+        return self[0], self[1]
+
+    @property
+    def index(self):
+        return self[0] * 8 + self[1]
 
     @classmethod
     def get_square(cls, *args):
         if len(args) == 1:
             arg = args[0]
-            if type(arg) == tuple:
+            if type(arg) == Square:
+                return arg
+            elif type(arg) == tuple:
                 return cls(arg)
             elif type(arg) == str:
                 return cls.from_name(arg)
-            elif type(arg) == Square:
-                return arg
         elif len(args) == 2:
             a, b = args
             if type(a) == type(b) == int:
                 return cls(args)
 
     def get_diff(self, diff):
-        row = self.row + diff[0]
-        col = self.col + diff[1]
+        row = self[0] + diff[0]
+        col = self[1] + diff[1]
         return Square((row, col))
 
     @staticmethod
     def is_valid(square):
-        return 0 <= square.row < 8 and 0 <= square.col < 8
+        return 0 <= square[0] < 8 and 0 <= square[1] < 8
 
     def convert_to_name(self):
-        files = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h']
-        ranks = ['8', '7', '6', '5', '4', '3', '2', '1']
-
-        file = files[self.col]
-        rank = ranks[self.row]
-
-        return file + rank
+        return SQUARE_NAMES[self.index]
 
     @classmethod
     def convert_to_coords(cls, name):
@@ -98,7 +163,11 @@ class Square(tuple):
 
     @classmethod
     def from_name(cls, name):
-        return cls(cls.convert_to_coords(name))
+        return SQUARES_BY_NAME[name.lower()]
+
+    @classmethod
+    def from_index(cls, index):
+        return SQUARES[index]
 
     def __str__(self):
         return self.convert_to_name()
@@ -106,8 +175,10 @@ class Square(tuple):
     def __repr__(self):
         return self.convert_to_name()
 
-    def __eq__(self, other):
-        return self.coords == other.coords
+
+SQUARES = [tuple.__new__(Square, divmod(index, 8)) for index in range(64)]
+SQUARE_NAMES = [file + rank for rank in "87654321" for file in "abcdefgh"]
+SQUARES_BY_NAME = dict(zip(SQUARE_NAMES, SQUARES))
 
 
 class Move:
@@ -119,8 +190,39 @@ class Move:
         self.promotion = promotion
         self.check = check
         self.mate = mate
+        self.san = None  # standard algebraic notation, recorded by Game.make_notated_move for moves that are shown
+
+    @classmethod
+    def from_packed(cls, packed, board):
+        initial_index, final_index, flags = unpack_move(packed)
+        initial_loc = Square.from_index(initial_index)
+        final_loc = Square.from_index(final_index)
+
+        if flags == EN_PASSANT_CAPTURE:
+            piece_captured = board.en_passant[2]
+        else:
+            piece_captured = board.get(final_loc)
+
+        return cls(initial_loc, final_loc, board.get(initial_loc), piece_captured, promotion=packed_promotion(packed))
+
+    def to_packed(self):
+        flags = QUIET
+        if self.piece_moved.piece_type == PAWN:
+            if self.promotion is not None:
+                flags = PROMOTION | (self.promotion - KNIGHT)
+            elif abs(self.final_loc.row - self.initial_loc.row) == 2:
+                flags = DOUBLE_PAWN_PUSH
+            if self.piece_captured is not None:
+                flags |= EN_PASSANT_CAPTURE if self.piece_captured.square != self.final_loc else CAPTURE
+        elif self.piece_moved.piece_type == KING and abs(self.final_loc.col - self.initial_loc.col) == 2:
+            flags = KING_CASTLE if self.final_loc.col == 6 else QUEEN_CASTLE
+        elif self.piece_captured is not None:
+            flags = CAPTURE
+
+        return pack_move(self.initial_loc.index, self.final_loc.index, flags)
 
     def to_algebraic_notation(self):
+        # Short notation that needs no game, so it does not tell apart pieces that can reach the same square. Game.san does
         notation = ""
         if self.piece_moved.piece_type == PAWN:
             if self.piece_captured:
@@ -133,9 +235,7 @@ class Move:
             notation += self.final_loc.convert_to_name()
         elif self.piece_moved.piece_type == KING:
             if abs(self.final_loc.col - self.initial_loc.col) == 2:
-                notation = "O-O"
-            elif abs(self.final_loc.col - self.initial_loc.col) == 3:
-                notation = "O-O-O"
+                notation = "O-O" if self.final_loc.col == 6 else "O-O-O"
             else:
                 notation += str(self.piece_moved).upper()
                 if self.piece_captured:
@@ -150,19 +250,293 @@ class Move:
         return notation
 
 
-class Board:
+# Lookup tables are indexed by square index (row * 8 + col), so a8 is 0 and h1 is 63. Bitboards use the same numbering, one bit per square
+KNIGHT_DIFFS = [(-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1)]
+KING_DIFFS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+DIRECTIONS = [(-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)]  # rook directions, then bishop directions
+ROOK_DIRECTIONS = range(0, 4)
+BISHOP_DIRECTIONS = range(4, 8)
+QUEEN_DIRECTIONS = range(0, 8)
+
+
+
+def build_step_targets(diffs):
+    targets = []
+    for square in SQUARES:
+        targets.append([SQUARES[(square.row + drow) * 8 + square.col + dcol] for drow, dcol in diffs
+                        if 0 <= square.row + drow < 8 and 0 <= square.col + dcol < 8])
+
+    return targets
+
+
+def build_pawn_pushes(color):
+    pushes = []
+    start_row = 6 if color == WHITE else 1
+    for square in SQUARES:
+        squares = []
+        if 0 <= square.row + color < 8:
+            squares.append(SQUARES[square.index + 8 * color])
+            if square.row == start_row:
+                squares.append(SQUARES[square.index + 16 * color])
+        pushes.append(squares)
+
+    return pushes
+
+
+def build_rays(direction):
+    drow, dcol = direction
+    rays = []
+    for square in SQUARES:
+        ray = []
+        row, col = square.row + drow, square.col + dcol
+        while 0 <= row < 8 and 0 <= col < 8:
+            ray.append(SQUARES[row * 8 + col])
+            row, col = row + drow, col + dcol
+        rays.append(ray)
+
+    return rays
+
+
+def to_masks(targets):
+    return [sum(1 << square.index for square in squares) for squares in targets]
+
+
+def bit_indices(bb):
+    while bb:
+        lsb = bb & -bb
+        yield lsb.bit_length() - 1
+        bb ^= lsb
+
+
+KNIGHT_TARGETS = build_step_targets(KNIGHT_DIFFS)
+KING_TARGETS = build_step_targets(KING_DIFFS)
+PAWN_CAPTURE_TARGETS = {WHITE: build_step_targets([(-1, -1), (-1, 1)]), BLACK: build_step_targets([(1, -1), (1, 1)])}
+PAWN_PUSH_TARGETS = {WHITE: build_pawn_pushes(WHITE), BLACK: build_pawn_pushes(BLACK)}
+RAY_SQUARES = [build_rays(direction) for direction in DIRECTIONS]
+
+KNIGHT_ATTACKS = to_masks(KNIGHT_TARGETS)
+KING_ATTACKS = to_masks(KING_TARGETS)
+PAWN_ATTACKS = {color: to_masks(targets) for color, targets in PAWN_CAPTURE_TARGETS.items()}
+RAYS = [to_masks(rays) for rays in RAY_SQUARES]
+RAY_IS_POSITIVE = [drow * 8 + dcol > 0 for drow, dcol in DIRECTIONS]
+FULL_BOARD = (1 << 64) - 1
+LIGHT_SQUARES = sum(1 << index for index in range(64) if (index // 8 + index % 8) % 2 == 0)
+
+
+def build_between():
+    between = [[0] * 64 for _ in range(64)]
+    for rays in RAY_SQUARES:
+        for square in SQUARES:
+            mask = 0
+            for target in rays[square.index]:
+                between[square.index][target.index] = mask
+                mask |= 1 << target.index
+
+    return between
+
+
+BETWEEN = build_between()  # squares strictly between two squares on a shared line, 0 if they are not on one
+
+# (right index in Board.castling, king's home square, king's castled square)
+CASTLING_MOVES = [(0, "e1", "g1"), (1, "e1", "c1"), (2, "e8", "g8"), (3, "e8", "c8")]
+# squares that must be empty and squares the king must not be attacked on, for each entry of CASTLING_MOVES
+CASTLING_PATHS = [
+    (to_masks([[Square.from_name(name) for name in empty]])[0], to_masks([[Square.from_name(name) for name in safe]])[0])
+    for empty, safe in [(["f1", "g1"], ["e1", "f1", "g1"]), (["b1", "c1", "d1"], ["e1", "d1", "c1"]),
+                        (["f8", "g8"], ["e8", "f8", "g8"]), (["b8", "c8", "d8"], ["e8", "d8", "c8"])]
+]
+ROOK_HOMES = {"h1": 0, "a1": 1, "h8": 2, "a8": 3}
+
+# Zobrist keys, drawn from a fixed seed so that every process hashes a position to the same value
+zobrist_random = random.Random(0x5EED)
+ZOBRIST_PIECES = {color: [[zobrist_random.getrandbits(64) for _ in range(64)] for _ in range(6)] for color in [WHITE, BLACK]}
+ZOBRIST_CASTLING = [zobrist_random.getrandbits(64) for _ in range(4)]
+ZOBRIST_EN_PASSANT = [zobrist_random.getrandbits(64) for _ in range(8)]  # by file of the en passant square
+ZOBRIST_BLACK_TO_MOVE = zobrist_random.getrandbits(64)
+
+
+class BitBoard:
     def __init__(self):
-        self.board, self.pieces = self.initialize()
+        self.pieces = {WHITE: [0] * 6, BLACK: [0] * 6}
+        self.occupancy = {WHITE: 0, BLACK: 0}
+        self.occupied = 0
+
+    @classmethod
+    def from_board(cls, board):
+        bitboard = cls()
+        for piece in board.pieces:
+            if not piece.captured:
+                bitboard.add(piece.piece_type, piece.color, piece.square.index)
+
+        return bitboard
+
+    def to_board(self):
+        pieces = []
+        for color in [BLACK, WHITE]:
+            for piece_type in range(6):
+                for index in bit_indices(self.pieces[color][piece_type]):
+                    pieces.append(Piece(piece_type, color, Square.from_index(index)))
+
+        board = Board(pieces)
+
+        # castling rights are not stored in bitboards, so assume them wherever king and rook are still on their home squares
+        board.castling = self.castling_available()
+        board.zobrist_key = board.compute_zobrist_key(WHITE)
+
+        return board
+
+    def castling_available(self):
+        # for each castling right, whether its king and rook are still on their home squares
+        homes = [("e1", "h1", WHITE), ("e1", "a1", WHITE), ("e8", "h8", BLACK), ("e8", "a8", BLACK)]
+        available = []
+        for king_square, rook_square, color in homes:
+            king_bit = 1 << Square.from_name(king_square).index
+            rook_bit = 1 << Square.from_name(rook_square).index
+            available.append(bool(self.pieces[color][KING] & king_bit and self.pieces[color][ROOK] & rook_bit))
+
+        return available
+
+    def has_insufficient_material(self):
+        # No sequence of moves can mate: bare kings, a single knight, or bishops that all stand on one color of square
+        white = self.pieces[WHITE]
+        black = self.pieces[BLACK]
+        if white[PAWN] | black[PAWN] | white[ROOK] | black[ROOK] | white[QUEEN] | black[QUEEN]:
+            return False
+
+        knights = white[KNIGHT] | black[KNIGHT]
+        bishops = white[BISHOP] | black[BISHOP]
+        if not bishops:
+            return knights & (knights - 1) == 0
+        if knights:
+            return False
+
+        return not bishops & LIGHT_SQUARES or not bishops & ~LIGHT_SQUARES
+
+    def add(self, piece_type, color, index):
+        bit = 1 << index
+        self.pieces[color][piece_type] |= bit
+        self.occupancy[color] |= bit
+        self.occupied |= bit
+
+    def remove(self, piece_type, color, index):
+        bit = ~(1 << index)
+        self.pieces[color][piece_type] &= bit
+        self.occupancy[color] &= bit
+        self.occupied &= bit
+
+    @staticmethod
+    def nearest(direction, blockers):
+        if RAY_IS_POSITIVE[direction]:
+            return (blockers & -blockers).bit_length() - 1
+        return blockers.bit_length() - 1
+
+    def slider_attacks(self, index, directions):
+        attacks = 0
+        for direction in directions:
+            ray = RAYS[direction][index]
+            blockers = ray & self.occupied
+            if blockers:
+                ray ^= RAYS[direction][self.nearest(direction, blockers)]
+            attacks |= ray
+
+        return attacks
+
+    def attacks(self, piece_type, color, index):
+        if piece_type == PAWN:
+            return PAWN_ATTACKS[color][index]
+        elif piece_type == KNIGHT:
+            return KNIGHT_ATTACKS[index]
+        elif piece_type == BISHOP:
+            return self.slider_attacks(index, BISHOP_DIRECTIONS)
+        elif piece_type == ROOK:
+            return self.slider_attacks(index, ROOK_DIRECTIONS)
+        elif piece_type == QUEEN:
+            return self.slider_attacks(index, QUEEN_DIRECTIONS)
+        elif piece_type == KING:
+            return KING_ATTACKS[index]
+
+    def is_attacked(self, index, by_color) -> bool:
+        pieces = self.pieces[by_color]
+
+        # a square is attacked by a piece exactly when that piece type, standing on the square, would attack the piece
+        if KNIGHT_ATTACKS[index] & pieces[KNIGHT]:
+            return True
+        if KING_ATTACKS[index] & pieces[KING]:
+            return True
+        if PAWN_ATTACKS[-by_color][index] & pieces[PAWN]:
+            return True
+
+        rooks = pieces[ROOK] | pieces[QUEEN]
+        if rooks and self.slider_attacks(index, ROOK_DIRECTIONS) & rooks:
+            return True
+
+        bishops = pieces[BISHOP] | pieces[QUEEN]
+        if bishops and self.slider_attacks(index, BISHOP_DIRECTIONS) & bishops:
+            return True
+
+        return False
+
+    def attackers_of(self, index, by_color):
+        pieces = self.pieces[by_color]
+        attackers = (KNIGHT_ATTACKS[index] & pieces[KNIGHT]) | (KING_ATTACKS[index] & pieces[KING]) | (PAWN_ATTACKS[-by_color][index] & pieces[PAWN])
+
+        rooks = pieces[ROOK] | pieces[QUEEN]
+        if rooks:
+            attackers |= self.slider_attacks(index, ROOK_DIRECTIONS) & rooks
+
+        bishops = pieces[BISHOP] | pieces[QUEEN]
+        if bishops:
+            attackers |= self.slider_attacks(index, BISHOP_DIRECTIONS) & bishops
+
+        return attackers
+
+    def pin_masks(self, king_index, color):
+        # maps each pinned piece's square to the squares it may still move to: the line from its king up to and including the pinner
+        pins = {}
+        own = self.occupancy[color]
+        enemy = self.pieces[-color]
+        for direction in QUEEN_DIRECTIONS:
+            ray = RAYS[direction][king_index]
+            blockers = ray & self.occupied
+            if not blockers:
+                continue
+
+            first = self.nearest(direction, blockers)
+            if not own >> first & 1:
+                continue
+
+            beyond = RAYS[direction][first] & self.occupied
+            if not beyond:
+                continue
+
+            second = self.nearest(direction, beyond)
+            sliders = enemy[QUEEN] | (enemy[ROOK] if direction in ROOK_DIRECTIONS else enemy[BISHOP])
+            if sliders >> second & 1:
+                pins[first] = ray ^ RAYS[direction][second]
+
+        return pins
+
+
+class Board:
+    def __init__(self, pieces=None):
+        if pieces is None:
+            self.board, self.pieces = self.initialize()
+        else:
+            self.board, self.pieces = self.place(pieces)
         self.castling = [True] * 4  # white king-side, white queen-side, black king-side, black queen-side
         self.en_passant = [False, None, None]  # is there en passant, where it is, what pawn moved 2
+        self.halfmove_clock = 0  # moves since the last capture or pawn move
+        self.kings = {piece.color: piece for piece in self.pieces if piece.piece_type == KING}
+        self.bitboard = BitBoard.from_board(self)
+        self.zobrist_key = self.compute_zobrist_key(WHITE)
 
     @property
     def white_king(self) -> Piece:
-        return self.pieces[20]
+        return self.kings[WHITE]
 
     @property
     def black_king(self) -> Piece:
-        return self.pieces[4]
+        return self.kings[BLACK]
 
     @staticmethod
     def initialize():
@@ -214,6 +588,32 @@ class Board:
 
         return board, pieces
 
+    @staticmethod
+    def place(pieces):
+        board = np.full((8, 8), None, dtype=object)
+        for piece in pieces:
+            board[piece.square] = piece
+
+        return board, list(pieces)
+
+    def compute_zobrist_key(self, turn):
+        key = 0
+        for piece in self.pieces:
+            if not piece.captured:
+                key ^= ZOBRIST_PIECES[piece.color][piece.piece_type][piece.square.index]
+
+        for i in range(4):
+            if self.castling[i]:
+                key ^= ZOBRIST_CASTLING[i]
+
+        if self.en_passant[0]:
+            key ^= ZOBRIST_EN_PASSANT[self.en_passant[1].col]
+
+        if turn == BLACK:
+            key ^= ZOBRIST_BLACK_TO_MOVE
+
+        return key
+
     def apply_move(self, move: Move):
         initial_loc = move.initial_loc
         final_loc = move.final_loc
@@ -221,12 +621,24 @@ class Board:
         piece_captured: Piece = move.piece_captured
         promotion = move.promotion
 
+        # state needed by undo_move to reverse this move
+        castling = self.castling.copy()
+        en_passant = self.en_passant.copy()
+        piece_type = piece_moved.piece_type
+        rook_move = None
+        zobrist_key = self.zobrist_key
+        halfmove_clock = self.halfmove_clock
+
         self.board[initial_loc] = None
         self.board[piece_moved.square] = None
+        self.bitboard.remove(piece_type, piece_moved.color, initial_loc.index)
+        self.zobrist_key ^= ZOBRIST_PIECES[piece_moved.color][piece_type][initial_loc.index]
 
         if piece_captured:
             piece_captured.captured = True
             self.board[piece_captured.square] = None
+            self.bitboard.remove(piece_captured.piece_type, piece_captured.color, piece_captured.square.index)
+            self.zobrist_key ^= ZOBRIST_PIECES[piece_captured.color][piece_captured.piece_type][piece_captured.square.index]
 
         self.board[final_loc] = piece_moved
         piece_moved.move(final_loc)
@@ -238,36 +650,42 @@ class Board:
                 self.board[Square.from_name("h1")] = None
                 self.board[Square.from_name("f1")] = rook
                 rook.move(Square.from_name("f1"))
+                rook_move = (rook, Square.from_name("h1"), Square.from_name("f1"))
             elif final_loc == Square.from_name("c1"):
                 rook = self.get("a1")
                 self.board[Square.from_name("a1")] = None
                 self.board[Square.from_name("d1")] = rook
                 rook.move(Square.from_name("d1"))
+                rook_move = (rook, Square.from_name("a1"), Square.from_name("d1"))
             elif final_loc == Square.from_name("g8"):
                 rook = self.get("h8")
                 self.board[Square.from_name("h8")] = None
                 self.board[Square.from_name("f8")] = rook
                 rook.move(Square.from_name("f8"))
+                rook_move = (rook, Square.from_name("h8"), Square.from_name("f8"))
             elif final_loc == Square.from_name("c8"):
                 rook = self.get("a8")
                 self.board[Square.from_name("a8")] = None
                 self.board[Square.from_name("d8")] = rook
                 rook.move(Square.from_name("d8"))
+                rook_move = (rook, Square.from_name("a8"), Square.from_name("d8"))
+
+            if rook_move:
+                self.bitboard.remove(ROOK, rook.color, rook_move[1].index)
+                self.bitboard.add(ROOK, rook.color, rook_move[2].index)
+                self.zobrist_key ^= ZOBRIST_PIECES[rook.color][ROOK][rook_move[1].index] ^ ZOBRIST_PIECES[rook.color][ROOK][rook_move[2].index]
 
         if promotion is not None:
             piece_moved.promote(promotion)
 
-        if piece_moved.piece_type == ROOK:
-            if piece_moved.color == WHITE:
-                if initial_loc.convert_to_name() == "a1":
-                    self.castling[1] = False
-                else:
-                    self.castling[0] = False
-            else:
-                if initial_loc.convert_to_name() == "a8":
-                    self.castling[3] = False
-                else:
-                    self.castling[2] = False
+        self.bitboard.add(piece_moved.piece_type, piece_moved.color, final_loc.index)
+        self.zobrist_key ^= ZOBRIST_PIECES[piece_moved.color][piece_moved.piece_type][final_loc.index]
+
+        # a rook leaving or being captured on its home corner loses that side's castling right
+        if piece_moved.piece_type == ROOK and initial_loc.convert_to_name() in ROOK_HOMES:
+            self.castling[ROOK_HOMES[initial_loc.convert_to_name()]] = False
+        if piece_captured and piece_captured.piece_type == ROOK and piece_captured.square.convert_to_name() in ROOK_HOMES:
+            self.castling[ROOK_HOMES[piece_captured.square.convert_to_name()]] = False
 
         if piece_moved.piece_type == KING:
             if piece_moved.color == WHITE:
@@ -277,23 +695,220 @@ class Board:
 
         self.en_passant = [False, None, None]
         if piece_moved.piece_type == PAWN:
-            if abs(final_loc.coords[0] - initial_loc.coords[0]) == 2:
+            if abs(final_loc.row - initial_loc.row) == 2:
                 if piece_moved.color == WHITE:
                     self.en_passant = [True, Square((initial_loc.row - 1, initial_loc.col)), piece_moved]
                 else:
                     self.en_passant = [True, Square((initial_loc.row + 1, initial_loc.col)), piece_moved]
 
+        for i in range(4):
+            if castling[i] != self.castling[i]:
+                self.zobrist_key ^= ZOBRIST_CASTLING[i]
+        if en_passant[0]:
+            self.zobrist_key ^= ZOBRIST_EN_PASSANT[en_passant[1].col]
+        if self.en_passant[0]:
+            self.zobrist_key ^= ZOBRIST_EN_PASSANT[self.en_passant[1].col]
+        self.zobrist_key ^= ZOBRIST_BLACK_TO_MOVE
+
+        if piece_type == PAWN or piece_captured:
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
+
+        return move, piece_type, castling, en_passant, rook_move, zobrist_key, halfmove_clock
+
+    def undo_move(self, undo):
+        move, piece_type, castling, en_passant, rook_move, zobrist_key, halfmove_clock = undo
+        piece_moved = move.piece_moved
+        piece_captured = move.piece_captured
+
+        self.board[move.final_loc] = None
+        self.bitboard.remove(piece_moved.piece_type, piece_moved.color, move.final_loc.index)
+
+        if rook_move:
+            rook, rook_initial_loc, rook_final_loc = rook_move
+            self.board[rook_final_loc] = None
+            self.board[rook_initial_loc] = rook
+            rook.move(rook_initial_loc)
+            self.bitboard.remove(ROOK, rook.color, rook_final_loc.index)
+            self.bitboard.add(ROOK, rook.color, rook_initial_loc.index)
+
+        piece_moved.piece_type = piece_type
+        piece_moved.move(move.initial_loc)
+        self.board[move.initial_loc] = piece_moved
+        self.bitboard.add(piece_type, piece_moved.color, move.initial_loc.index)
+
+        if piece_captured:
+            piece_captured.captured = False
+            self.board[piece_captured.square] = piece_captured
+            self.bitboard.add(piece_captured.piece_type, piece_captured.color, piece_captured.square.index)
+
+        self.castling = castling
+        self.en_passant = en_passant
+        self.zobrist_key = zobrist_key
+        self.halfmove_clock = halfmove_clock
+
     def get(self, square) -> Piece:
         return self.board[Square.get_square(square)]
 
 
 class Game:
-    def __init__(self):
-        self.board = Board()
+    def __init__(self, board=None):
+        self.board = Board() if board is None else board
         self.turn = WHITE
+        self.fullmove_number = 1
         self.moves = []
+        self.start_fen = STARTING_FEN if board is None else None  # position the moves were played from, when known
+        self.position_counts = {self.board.zobrist_key: 1}  # times each position has been reached, by Zobrist key
+        self.status = None  # [position tag, legal moves, in check, result, legal packed moves by squares] for the position it was computed in
+
+    def __getstate__(self):
+        # the cached status is cheap to rebuild, so leave it out of pickles
+        state = self.__dict__.copy()
+        state["status"] = None
+        return state
+
+    @classmethod
+    def from_fen(cls, fen):
+        fields = fen.split()
+        if len(fields) < 4:
+            raise ValueError(f"FEN needs at least 4 fields: {fen}")
+        placement, active_color, castling, en_passant = fields[:4]
+
+        ranks = placement.split("/")
+        if len(ranks) != 8:
+            raise ValueError(f"FEN piece placement needs 8 ranks: {placement}")
+
+        pieces = []
+        for row, rank in enumerate(ranks):
+            col = 0
+            for char in rank:
+                if char.isdigit():
+                    col += int(char)
+                elif char.lower() in "pnbrqk" and col < 8:
+                    color = WHITE if char.isupper() else BLACK
+                    pieces.append(Piece("pnbrqk".index(char.lower()), color, SQUARES[row * 8 + col]))
+                    col += 1
+                else:
+                    raise ValueError(f"Invalid FEN rank: {rank}")
+            if col != 8:
+                raise ValueError(f"Invalid FEN rank: {rank}")
+
+        for color in [WHITE, BLACK]:
+            if sum(1 for piece in pieces if piece.piece_type == KING and piece.color == color) != 1:
+                raise ValueError(f"FEN needs exactly one king per side: {placement}")
+
+        if active_color not in ["w", "b"]:
+            raise ValueError(f"Invalid FEN active color: {active_color}")
+        if not FEN_CASTLING_PATTERN.fullmatch(castling):
+            raise ValueError(f"Invalid FEN castling rights: {castling}")
+
+        board = Board(pieces)
+        game = cls(board)
+        game.turn = WHITE if active_color == "w" else BLACK
+
+        # rights whose king or rook has left home cannot be used, whatever the FEN says
+        board.castling = [letter in castling and available for letter, available in zip("KQkq", board.bitboard.castling_available())]
+
+        if en_passant != "-":
+            square = SQUARES_BY_NAME.get(en_passant)
+            # The square a pawn skipped over on the move just played: rank 6 with white to move, rank 3 with black
+            if square is None or square.row != (2 if game.turn == WHITE else 5):
+                raise ValueError(f"Invalid FEN en passant square: {en_passant}")
+            pawn = board.get((square.row + (1 if game.turn == WHITE else -1), square.col))
+            if pawn is None or pawn.piece_type != PAWN or pawn.color == game.turn:
+                raise ValueError(f"No pawn to capture en passant on {en_passant}")
+            board.en_passant = [True, square, pawn]
+
+        if len(fields) > 4:
+            board.halfmove_clock = int(fields[4])
+        if len(fields) > 5:
+            game.fullmove_number = int(fields[5])
+
+        board.zobrist_key = board.compute_zobrist_key(game.turn)
+        game.position_counts = {board.zobrist_key: 1}
+        game.start_fen = game.to_fen()
+
+        return game
+
+    def to_fen(self):
+        ranks = []
+        for row in range(8):
+            rank = ""
+            empty = 0
+            for col in range(8):
+                piece = self.board.board[row, col]
+                if piece is None:
+                    empty += 1
+                    continue
+                if empty:
+                    rank += str(empty)
+                    empty = 0
+                rank += str(piece)
+            if empty:
+                rank += str(empty)
+            ranks.append(rank)
+
+        castling = "".join(letter for letter, right in zip("KQkq", self.board.castling) if right) or "-"
+        en_passant = self.board.en_passant[1].convert_to_name() if self.board.en_passant[0] else "-"
+        active_color = "w" if self.turn == WHITE else "b"
+
+        return f"{'/'.join(ranks)} {active_color} {castling} {en_passant} {self.board.halfmove_clock} {self.fullmove_number}"
+
+    def get_status(self):
+        tag = (self.board.zobrist_key, len(self.moves))
+        if self.status is None or self.status[0] != tag:
+            king = self.board.white_king if self.turn == WHITE else self.board.black_king
+            in_check = self.is_targeted(-self.turn, king.square, check_if_exposes_king=False)
+            self.set_status(self.generate_packed_moves_for(self.turn), in_check)
+
+        return self.status
+
+    def set_status(self, packed_moves, in_check):
+        # Also used to fill in a status worked out elsewhere, such as in another process
+        if packed_moves:
+            result = GAME_IN_PLAY
+        elif in_check:
+            result = CHECKMATE
+        else:
+            result = STALEMATE
+
+        by_squares = {(packed & 63, packed >> 6 & 63, packed_promotion(packed)): packed for packed in packed_moves}
+
+        # The legal moves are only turned into Move objects if they are asked for, since most callers look moves up by squares
+        self.status = [(self.board.zobrist_key, len(self.moves)), None, in_check, result, by_squares]
+
+    def get_legal_moves(self):
+        status = self.get_status()
+        if status[1] is None:
+            status[1] = [Move.from_packed(packed, self.board) for packed in status[4].values()]
+
+        return status[1]
+
+    def is_in_check(self):
+        return self.get_status()[2]
+
+    def find_legal_move(self, initial_index, final_index, promotion=None):
+        # The packed legal move of the side to move between these squares, or None if there is none
+        return self.get_status()[4].get((initial_index, final_index, promotion))
 
     def is_move_legal(self, move: Move, check_if_exposes_king=True) -> bool:
+        if not self.is_move_pseudo_legal(move):
+            return False
+
+        if check_if_exposes_king:
+            color = move.piece_moved.color
+            undo = self.make_move(Move(move.initial_loc, move.final_loc, move.piece_moved, self.board.get(move.final_loc), promotion=move.promotion))
+            king = self.board.white_king if color == WHITE else self.board.black_king
+            exposed = self.is_targeted(-color, king.square, check_if_exposes_king=False)
+            self.unmake_move(undo)
+
+            if exposed:
+                return False
+
+        return True
+
+    def is_move_pseudo_legal(self, move: Move) -> bool:
         initial_loc: Square = move.initial_loc
         final_loc: Square = move.final_loc
         piece_moved: Piece = move.piece_moved
@@ -310,24 +925,6 @@ class Game:
         if piece_captured and piece_captured.color == piece_moved.color:
             return False
 
-        if check_if_exposes_king:
-            test_game = copy.deepcopy(self)
-            test_move = Move(
-                initial_loc=initial_loc,
-                final_loc=final_loc,
-                piece_moved=test_game.board.get(initial_loc),
-                piece_captured=test_game.board.get(final_loc),
-            )
-            test_move = test_game.correct_en_passant(test_move)
-            test_game.move(test_move)
-
-            if piece_moved.color == WHITE:
-                if test_game.is_targeted(BLACK, test_game.board.white_king.square, check_if_exposes_king=False):
-                    return False
-            else:
-                if self.is_targeted(WHITE, test_game.board.black_king.square, check_if_exposes_king=False):
-                    return False
-
         if piece_moved.piece_type == PAWN:
             if hdist == 0 and not piece_captured:
                 if vdist == -1 and piece_moved.color == WHITE:
@@ -428,72 +1025,55 @@ class Game:
                     return True
         elif piece_moved.piece_type == KING:
             if -1 <= hdist <= 1 and -1 <= vdist <= 1:
-                if piece_moved.color == WHITE and not self.is_targeted(targeting_color=BLACK, targeted_square=final_loc):
+                if piece_moved.color == WHITE and not self.is_targeted(targeting_color=BLACK, targeted_square=final_loc, check_if_exposes_king=False):
                     return True
-                elif not self.is_targeted(targeting_color=WHITE, targeted_square=final_loc):
+                elif piece_moved.color == BLACK and not self.is_targeted(targeting_color=WHITE, targeted_square=final_loc, check_if_exposes_king=False):
                     return True
             elif self.board.castling[0] and piece_moved.color == WHITE and final_loc == Square.from_name("g1"):
                 if not self.board.get("f1") and not self.board.get("g1") and \
-                        not self.is_targeted(targeting_color=BLACK, targeted_square=Square.from_name("f1")) and \
-                        not self.is_targeted(targeting_color=BLACK, targeted_square=Square.from_name("g1")):
+                        not self.is_targeted(targeting_color=BLACK, targeted_square=Square.from_name("e1"), check_if_exposes_king=False) and \
+                        not self.is_targeted(targeting_color=BLACK, targeted_square=Square.from_name("f1"), check_if_exposes_king=False) and \
+                        not self.is_targeted(targeting_color=BLACK, targeted_square=Square.from_name("g1"), check_if_exposes_king=False):
                     return True
             elif self.board.castling[1] and piece_moved.color == WHITE and final_loc == Square.from_name("c1"):
                 if not self.board.get("d1") and not self.board.get("c1") and not self.board.get("b1") and \
-                        not self.is_targeted(targeting_color=BLACK, targeted_square=Square.from_name("d1")) and \
-                        not self.is_targeted(targeting_color=BLACK, targeted_square=Square.from_name("c1")) and \
-                        not self.is_targeted(targeting_color=BLACK, targeted_square=Square.from_name("b1")):
+                        not self.is_targeted(targeting_color=BLACK, targeted_square=Square.from_name("e1"), check_if_exposes_king=False) and \
+                        not self.is_targeted(targeting_color=BLACK, targeted_square=Square.from_name("d1"), check_if_exposes_king=False) and \
+                        not self.is_targeted(targeting_color=BLACK, targeted_square=Square.from_name("c1"), check_if_exposes_king=False):
                     return True
             elif self.board.castling[2] and piece_moved.color == BLACK and final_loc == Square.from_name("g8"):
                 if not self.board.get("f8") and not self.board.get("g8") and \
-                        not self.is_targeted(targeting_color=WHITE, targeted_square=Square.from_name("f8")) and \
-                        not self.is_targeted(targeting_color=WHITE, targeted_square=Square.from_name("g8")):
+                        not self.is_targeted(targeting_color=WHITE, targeted_square=Square.from_name("e8"), check_if_exposes_king=False) and \
+                        not self.is_targeted(targeting_color=WHITE, targeted_square=Square.from_name("f8"), check_if_exposes_king=False) and \
+                        not self.is_targeted(targeting_color=WHITE, targeted_square=Square.from_name("g8"), check_if_exposes_king=False):
                     return True
             elif self.board.castling[3] and piece_moved.color == BLACK and final_loc == Square.from_name("c8"):
                 if not self.board.get("d8") and not self.board.get("c8") and not self.board.get("b8") and \
-                        not self.is_targeted(targeting_color=WHITE, targeted_square=Square.from_name("d8")) and \
-                        not self.is_targeted(targeting_color=WHITE, targeted_square=Square.from_name("c8")) and \
-                        not self.is_targeted(targeting_color=WHITE, targeted_square=Square.from_name("b8")):
+                        not self.is_targeted(targeting_color=WHITE, targeted_square=Square.from_name("e8"), check_if_exposes_king=False) and \
+                        not self.is_targeted(targeting_color=WHITE, targeted_square=Square.from_name("d8"), check_if_exposes_king=False) and \
+                        not self.is_targeted(targeting_color=WHITE, targeted_square=Square.from_name("c8"), check_if_exposes_king=False):
                     return True
 
         return legal
 
     def is_targeted(self, targeting_color, targeted_square: Square, check_if_exposes_king=True) -> bool:
-        targeting_pieces = [piece for piece in self.board.pieces if piece.color == targeting_color and piece.captured is False]
-
-        for piece in targeting_pieces:
-            hdist = targeted_square.col - piece.square.col
-            vdist = targeted_square.row - piece.square.row
-
-            if piece.piece_type == PAWN:
-                if targeting_color == WHITE:
-                    if abs(hdist) == 1 and vdist == -1:
-                        return True
-                elif targeting_color == BLACK:
-                    if abs(hdist) == 1 and vdist == 1:
-                        return True
-            elif piece.piece_type in [KNIGHT, BISHOP, ROOK, QUEEN]:
-                if self.is_move_legal(Move(piece.square, targeted_square, piece), check_if_exposes_king=check_if_exposes_king):
-                    return True
-            elif piece.piece_type == KING:
-                if -1 <= hdist <= 1 and -1 <= vdist <= 1:
-                    return True
-
-        return False
+        # pins do not stop a piece from attacking a square, so check_if_exposes_king no longer changes the result
+        return self.board.bitboard.is_attacked(Square.get_square(targeted_square).index, targeting_color)
 
     def check_if_game_ended(self):
-        moves = self.generate_legal_moves_for(self.turn)
+        result = self.get_status()[3]
+        if result != GAME_IN_PLAY:
+            return result
 
-        if len(moves) == 0:
-            if self.turn == WHITE:
-                if self.is_targeted(BLACK, self.board.white_king.square, check_if_exposes_king=False):
-                    return CHECKMATE
-                else:
-                    return STALEMATE
-            else:
-                if self.is_targeted(WHITE, self.board.black_king.square, check_if_exposes_king=False):
-                    return CHECKMATE
-                else:
-                    return STALEMATE
+        # These depend on how the position was reached, so they are not cached with the status
+        if self.position_counts[self.board.zobrist_key] >= 3:
+            return REPETITION
+        if self.board.halfmove_clock >= 100:
+            return FIFTY_MOVE_RULE
+        if self.board.bitboard.has_insufficient_material():
+            return INSUFFICIENT_MATERIAL
+
+        return GAME_IN_PLAY
 
     def correct_en_passant(self, move: Move) -> Move:
         initial_loc = move.initial_loc
@@ -514,44 +1094,92 @@ class Game:
 
         return move
 
-    def move(self, move):
+    def make_move(self, move):
         move = self.correct_en_passant(move)
-        self.board.apply_move(move)
+        undo = self.board.apply_move(move)
         self.moves.append(move)
+        if self.turn == BLACK:
+            self.fullmove_number += 1
         self.turn *= -1
 
-    def generate_legal_squares_to_move_to_for(self, piece: Piece):
-        all_squares = []
+        key = self.board.zobrist_key
+        self.position_counts[key] = self.position_counts.get(key, 0) + 1
+
+        return undo
+
+    def unmake_move(self, undo):
+        key = self.board.zobrist_key
+        count = self.position_counts[key] - 1
+        if count:
+            self.position_counts[key] = count
+        else:
+            del self.position_counts[key]
+
+        self.board.undo_move(undo)
+        self.moves.pop()
+        self.turn *= -1
+        if self.turn == BLACK:
+            self.fullmove_number -= 1
+
+    def move(self, move):
+        self.make_move(move)
+
+    def generate_pseudo_legal_squares_for(self, piece: Piece):
+        square = piece.square
+        index = square.index
+        color = piece.color
         squares = []
+
         if piece.piece_type == PAWN:
-            if piece.color == WHITE:
-                diffs = [[-1, 0], [-2, 0], [-1, -1], [-1, 1]]
-                all_squares = [piece.square.get_diff(diff) for diff in diffs if Square.is_valid(piece.square.get_diff(diff))]
+            for target in PAWN_PUSH_TARGETS[color][index]:
+                if self.board.get(target) is not None:
+                    break
+                squares.append(target)
+            for target in PAWN_CAPTURE_TARGETS[color][index]:
+                captured = self.board.get(target)
+                if (captured is not None and captured.color != color) or (self.board.en_passant[0] and target == self.board.en_passant[1]):
+                    squares.append(target)
+        elif piece.piece_type == KNIGHT or piece.piece_type == KING:
+            targets = KNIGHT_TARGETS[index] if piece.piece_type == KNIGHT else KING_TARGETS[index]
+            for target in targets:
+                captured = self.board.get(target)
+                if captured is None or captured.color != color:
+                    squares.append(target)
+
+            if piece.piece_type == KING:
+                for right, home, castled in CASTLING_MOVES:
+                    if self.board.castling[right] and square == Square.from_name(home):
+                        squares.append(Square.from_name(castled))
+        else:
+            if piece.piece_type == BISHOP:
+                directions = BISHOP_DIRECTIONS
+            elif piece.piece_type == ROOK:
+                directions = ROOK_DIRECTIONS
             else:
-                diffs = [[1, 0], [2, 0], [1, -1], [1, 1]]
-                all_squares = [piece.square.get_diff(diff) for diff in diffs if Square.is_valid(piece.square.get_diff(diff))]
-        elif piece.piece_type == KNIGHT:
-            diffs = [[-2, -1], [-2, 1], [-1, -2], [-1, 2], [1, -2], [1, 2], [2, -1], [2, 1]]
-            all_squares = [piece.square.get_diff(diff) for diff in diffs if Square.is_valid(piece.square.get_diff(diff))]
-        elif piece.piece_type == BISHOP:
-            diffs = [[a, a] for a in range(-7, 8) if a != 0]
-            diffs.extend([[a, -a] for a in range(-7, 8) if a != 0])
-            all_squares = [piece.square.get_diff(diff) for diff in diffs if Square.is_valid(piece.square.get_diff(diff))]
-        elif piece.piece_type == ROOK:
-            diffs = [[a, 0] for a in range(-7, 8) if a != 0]
-            diffs.extend([[0, a] for a in range(-7, 8) if a != 0])
-            all_squares = [piece.square.get_diff(diff) for diff in diffs if Square.is_valid(piece.square.get_diff(diff))]
-        elif piece.piece_type == QUEEN:
-            diffs = [[a, a] for a in range(-7, 8) if a != 0]
-            diffs.extend([[a, -a] for a in range(-7, 8) if a != 0])
-            diffs.extend([[a, 0] for a in range(-7, 8) if a != 0])
-            diffs.extend([[0, a] for a in range(-7, 8) if a != 0])
-            all_squares = [piece.square.get_diff(diff) for diff in diffs if Square.is_valid(piece.square.get_diff(diff))]
-        elif piece.piece_type == KING:
-            diffs = [[-1, -1], [-1, 0], [-1, 1], [0, -1], [0, 1], [1, -1], [1, 0], [1, 1], [0, 2], [0, -3]]
-            all_squares = [piece.square.get_diff(diff) for diff in diffs if Square.is_valid(piece.square.get_diff(diff))]
-
-        for square in all_squares:
+                directions = QUEEN_DIRECTIONS
+
+            for direction in directions:
+                for target in RAY_SQUARES[direction][index]:
+                    captured = self.board.get(target)
+                    if captured is None:
+                        squares.append(target)
+                    else:
+                        if captured.color != color:
+                            squares.append(target)
+                        break
+
+        return squares
+
+    def generate_legal_squares_to_move_to_for(self, piece: Piece):
+        if piece.color == self.turn:
+            squares = []
+            for move in self.get_legal_moves():
+                if move.piece_moved is piece and move.final_loc not in squares:
+                    squares.append(move.final_loc)
+            return squares
+
+        squares = []
+        for square in self.generate_pseudo_legal_squares_for(piece):
             move = self.correct_en_passant(Move(piece.square, square, piece, self.board.get(square)))
             if self.is_move_legal(move):
                 squares.append(square)
@@ -559,41 +1187,161 @@ class Game:
         return squares
 
     def generate_legal_moves_for(self, color):
-        pieces = [piece for piece in self.board.pieces if piece.color == color and piece.captured is False]
-        moves = []
-        for piece in pieces:
-            final_locs = []
-            if piece.piece_type == PAWN:
-                if color == WHITE:
-                    diffs = [[-1, 0], [-2, 0], [-1, -1], [-1, 1]]
-                    final_locs = [piece.square.get_diff(diff) for diff in diffs if Square.is_valid(piece.square.get_diff(diff))]
+        return [Move.from_packed(packed, self.board) for packed in self.generate_packed_moves_for(color)]
+
+    def make_packed_move(self, packed):
+        return self.make_move(Move.from_packed(packed, self.board))
+
+    def make_notated_move(self, packed):
+        # Plays a legal packed move like make_packed_move, keeping its standard algebraic notation on the move for display
+        notation = self.san(packed)
+        undo = self.make_packed_move(packed)
+        self.moves[-1].san = notation
+
+        return undo
+
+    def san(self, packed):
+        # Standard algebraic notation of a legal packed move of the side to move
+        initial_index, final_index, flags = unpack_move(packed)
+        if flags == KING_CASTLE:
+            notation = "O-O"
+        elif flags == QUEEN_CASTLE:
+            notation = "O-O-O"
+        else:
+            board = self.board.board
+            piece_type = board[SQUARES[initial_index]].piece_type
+            capture = "x" if flags & CAPTURE else ""
+            origin = SQUARE_NAMES[initial_index]
+
+            if piece_type == PAWN:
+                notation = (origin[0] + capture if capture else "") + SQUARE_NAMES[final_index]
+                if flags & PROMOTION:
+                    notation += "=" + PIECE_LETTERS[packed_promotion(packed)]
+            else:
+                # Another piece of the same type that can go to the same square is told apart by file, then by rank
+                rivals = [SQUARE_NAMES[other & 63] for other in self.get_status()[4].values()
+                          if other >> 6 & 63 == final_index and other & 63 != initial_index and board[SQUARES[other & 63]].piece_type == piece_type]
+                disambiguation = ""
+                if rivals:
+                    if all(rival[0] != origin[0] for rival in rivals):
+                        disambiguation = origin[0]
+                    elif all(rival[1] != origin[1] for rival in rivals):
+                        disambiguation = origin[1]
+                    else:
+                        disambiguation = origin
+
+                notation = PIECE_LETTERS[piece_type] + disambiguation + capture + SQUARE_NAMES[final_index]
+
+        undo = self.make_packed_move(packed)
+        result = self.check_if_game_ended()
+        in_check = self.is_in_check()
+        self.unmake_move(undo)
+
+        if result == CHECKMATE:
+            notation += "#"
+        elif in_check:
+            notation += "+"
+
+        return notation
+
+    def parse_san(self, notation):
+        # The packed legal move of the side to move written as notation, raising ValueError if there is not exactly one
+        text = notation.rstrip("+#!?")
+        legal = self.get_status()[4].values()
+
+        if text in ["O-O", "0-0", "O-O-O", "0-0-0"]:
+            flags = KING_CASTLE if len(text) == 3 else QUEEN_CASTLE
+            candidates = [packed for packed in legal if packed >> 12 == flags]
+        else:
+            match = SAN_PATTERN.fullmatch(text)
+            if match is None:
+                raise ValueError(f"Invalid move: {notation}")
+
+            piece_letter, file, rank, destination, promotion_letter = match.groups()
+            piece_type = PIECE_LETTERS.index(piece_letter) if piece_letter else PAWN
+            final_index = SQUARES_BY_NAME[destination].index
+            promotion = PIECE_LETTERS.index(promotion_letter) if promotion_letter else None
+
+            board = self.board.board
+            candidates = []
+            for packed in legal:
+                initial_index = packed & 63
+                origin = SQUARE_NAMES[initial_index]
+                if packed >> 6 & 63 == final_index and packed_promotion(packed) == promotion and board[SQUARES[initial_index]].piece_type == piece_type \
+                        and (file is None or origin[0] == file) and (rank is None or origin[1] == rank):
+                    candidates.append(packed)
+
+        if len(candidates) != 1:
+            raise ValueError(f"{'Ambiguous' if candidates else 'Illegal'} move: {notation}")
+
+        return candidates[0]
+
+    def generate_packed_moves_for(self, color):
+        board = self.board
+        bitboard = board.bitboard
+        own = bitboard.occupancy[color]
+        enemy = bitboard.occupancy[-color]
+        king = board.kings[color]
+        king_index = king.square.index
+        moves = array('H')
+
+        checkers = bitboard.attackers_of(king_index, -color)
+        pins = bitboard.pin_masks(king_index, color)
+
+        # the king is lifted off the board while its targets are tested, so it cannot shield a square behind it from a slider
+        bitboard.remove(KING, color, king_index)
+        for index in bit_indices(KING_ATTACKS[king_index] & ~own):
+            if not bitboard.is_attacked(index, -color):
+                moves.append(pack_move(king_index, index, CAPTURE if enemy >> index & 1 else QUIET))
+        bitboard.add(KING, color, king_index)
+
+        if checkers & (checkers - 1):
+            # double check, only the king can move
+            return moves
+
+        if checkers:
+            # single check, other pieces must capture the checker or block its line
+            check_mask = checkers | BETWEEN[king_index][checkers.bit_length() - 1]
+        else:
+            check_mask = FULL_BOARD
+            for (right, home, castled), (empty, safe) in zip(CASTLING_MOVES, CASTLING_PATHS):
+                if board.castling[right] and king.square == Square.from_name(home) and not bitboard.occupied & empty and \
+                        not any(bitboard.is_attacked(index, -color) for index in bit_indices(safe)):
+                    castled_index = Square.from_name(castled).index
+                    moves.append(pack_move(king_index, castled_index, KING_CASTLE if castled_index > king_index else QUEEN_CASTLE))
+
+        for piece_type in [PAWN, KNIGHT, BISHOP, ROOK, QUEEN]:
+            for index in bit_indices(bitboard.pieces[color][piece_type]):
+                allowed = check_mask & pins[index] if index in pins else check_mask
+
+                if piece_type == PAWN:
+                    captures = PAWN_ATTACKS[color][index] & enemy & allowed
+                    pushes = 0
+                    push = index + 8 * color
+                    if 0 <= push < 64 and not bitboard.occupied >> push & 1:
+                        pushes |= 1 << push
+                        double_push = push + 8 * color
+                        if index // 8 == (6 if color == WHITE else 1) and not bitboard.occupied >> double_push & 1:
+                            pushes |= 1 << double_push
+                    pushes &= allowed
+
+                    for target in bit_indices(captures | pushes):
+                        flags = CAPTURE if captures >> target & 1 else QUIET
+                        if target < 8 or target >= 56:
+                            for promotion in [QUEEN, ROOK, BISHOP, KNIGHT]:
+                                moves.append(pack_move(index, target, PROMOTION | flags | (promotion - KNIGHT)))
+                        else:
+                            if abs(target - index) == 16:
+                                flags = DOUBLE_PAWN_PUSH
+                            moves.append(pack_move(index, target, flags))
+
+                    # en passant can expose the king along the rank of both pawns, which the pin masks miss, so it is tested by playing it
+                    if board.en_passant[0] and board.en_passant[2].color != color and PAWN_ATTACKS[color][index] >> board.en_passant[1].index & 1:
+                        move = Move(SQUARES[index], board.en_passant[1], board.board[SQUARES[index]], board.en_passant[2])
+                        if self.is_move_legal(move):
+                            moves.append(pack_move(index, board.en_passant[1].index, EN_PASSANT_CAPTURE))
                 else:
-                    diffs = [[1, 0], [2, 0], [1, -1], [1, 1]]
-                    final_locs = [piece.square.get_diff(diff) for diff in diffs if Square.is_valid(piece.square.get_diff(diff))]
-            elif piece.piece_type == KNIGHT:
-                diffs = [[-2, -1], [-2, 1], [-1, -2], [-1, 2], [1, -2], [1, 2], [2, -1], [2, 1]]
-                final_locs = [piece.square.get_diff(diff) for diff in diffs if Square.is_valid(piece.square.get_diff(diff))]
-            elif piece.piece_type == BISHOP:
-                diffs = [[a, a] for a in range(-7, 8) if a != 0]
-                diffs.extend([[a, -a] for a in range(-7, 8) if a != 0])
-                final_locs = [piece.square.get_diff(diff) for diff in diffs if Square.is_valid(piece.square.get_diff(diff))]
-            elif piece.piece_type == ROOK:
-                diffs = [[a, 0] for a in range(-7, 8) if a != 0]
-                diffs.extend([[0, a] for a in range(-7, 8) if a != 0])
-                final_locs = [piece.square.get_diff(diff) for diff in diffs if Square.is_valid(piece.square.get_diff(diff))]
-            elif piece.piece_type == QUEEN:
-                diffs = [[a, a] for a in range(-7, 8) if a != 0]
-                diffs.extend([[a, -a] for a in range(-7, 8) if a != 0])
-                diffs.extend([[a, 0] for a in range(-7, 8) if a != 0])
-                diffs.extend([[0, a] for a in range(-7, 8) if a != 0])
-                final_locs = [piece.square.get_diff(diff) for diff in diffs if Square.is_valid(piece.square.get_diff(diff))]
-            elif piece.piece_type == KING:
-                diffs = [[-1, -1], [-1, 0], [-1, 1], [0, -1], [0, 1], [1, -1], [1, 0], [1, 1], [0, 2], [0, -3]]
-                final_locs = [piece.square.get_diff(diff) for diff in diffs if Square.is_valid(piece.square.get_diff(diff))]
-
-            for final_loc in final_locs:
-                move = self.correct_en_passant(Move(piece.square, final_loc, piece, self.board.get(final_loc)))
-                if self.is_move_legal(move):
-                    moves.append(move)
+                    for target in bit_indices(bitboard.attacks(piece_type, color, index) & ~own & allowed):
+                        moves.append(pack_move(index, target, CAPTURE if enemy >> target & 1 else QUIET))
 
         return moves
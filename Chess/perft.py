@@ -0,0 +1,109 @@
+import argparse
+import sys
+import time
+
+from model import *
+
+# Standard test positions and their known node counts, by depth
+REFERENCE_POSITIONS = {
+    "startpos": (STARTING_FEN, {1: 20, 2: 400, 3: 8902, 4: 197281, 5: 4865609, 6: 119060324}),
+    "kiwipete": ("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+                 {1: 48, 2: 2039, 3: 97862, 4: 4085603}),
+    "position3": ("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", {1: 14, 2: 191, 3: 2812, 4: 43238, 5: 674624}),
+    "position4": ("r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1", {1: 6, 2: 264, 3: 9467, 4: 422333}),
+    "position5": ("rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8", {1: 44, 2: 1486, 3: 62379}),
+    "position6": ("r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10", {1: 46, 2: 2079, 3: 89890}),
+}
+
+
+def load_position(name):
+    if name not in REFERENCE_POSITIONS:
+        raise ValueError(f"Unknown position {name}")
+
+    return Game.from_fen(REFERENCE_POSITIONS[name][0])
+
+
+def move_name(move: Move):
+    name = move.initial_loc.convert_to_name() + move.final_loc.convert_to_name()
+    if move.promotion is not None:
+        name += "pnbrqk"[move.promotion]
+
+    return name
+
+
+def perft(game: Game, depth):
+    if depth <= 0:
+        return 1
+
+    moves = game.generate_packed_moves_for(game.turn)
+    if depth == 1:
+        return len(moves)
+
+    nodes = 0
+    for move in moves:
+        undo = game.make_packed_move(move)
+        nodes += perft(game, depth - 1)
+        game.unmake_move(undo)
+
+    return nodes
+
+
+def divide(game: Game, depth):
+    results = {}
+    for move in game.generate_legal_moves_for(game.turn):
+        undo = game.make_move(move)
+        results[move_name(move)] = perft(game, depth - 1)
+        game.unmake_move(undo)
+
+    return results
+
+
+def run_suite(positions, max_depth):
+    failures = 0
+    for name in positions:
+        for depth, expected in REFERENCE_POSITIONS[name][1].items():
+            if depth > max_depth:
+                continue
+
+            start = time.perf_counter()
+            nodes = perft(load_position(name), depth)
+            elapsed = time.perf_counter() - start
+
+            status = "ok" if nodes == expected else f"FAIL (expected {expected})"
+            if nodes != expected:
+                failures += 1
+
+            print(f"{name} depth {depth}: {nodes} nodes in {elapsed:.2f}s ({nodes / max(elapsed, 1e-9):,.0f} nodes/s) {status}")
+
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Count and time move generation from reference positions")
+    parser.add_argument("--depth", type=int, default=3, help="maximum depth to search")
+    parser.add_argument("--position", choices=list(REFERENCE_POSITIONS), help="only run this position")
+    parser.add_argument("--fen", help="position to use with --divide instead of --position")
+    parser.add_argument("--divide", action="store_true", help="print node counts per root move for --position at --depth")
+    args = parser.parse_args()
+    if args.depth < 1:
+        parser.error("--depth must be at least 1")
+
+    positions = [args.position] if args.position else list(REFERENCE_POSITIONS)
+
+    if args.divide:
+        game = Game.from_fen(args.fen) if args.fen else load_position(positions[0])
+        start = time.perf_counter()
+        results = divide(game, args.depth)
+        elapsed = time.perf_counter() - start
+
+        for name, nodes in sorted(results.items()):
+            print(f"{name}: {nodes}")
+        total = sum(results.values())
+        print(f"\nMoves: {len(results)}\nNodes: {total}\nTime: {elapsed:.2f}s ({total / max(elapsed, 1e-9):,.0f} nodes/s)")
+    else:
+        failures = run_suite(positions, args.depth)
+        sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+import argparse
+import re
+import time
+
+from model import *
+
+SEVEN_TAG_ROSTER = ["Event", "Site", "Date", "Round", "White", "Black", "Result"]
+RESULTS = ["1-0", "0-1", "1/2-1/2", "*"]
+LINE_LENGTH = 79
+
+TAG_PATTERN = re.compile(r'\[\s*(\w+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+# Comments, variation brackets, annotation glyphs, then anything else up to the next separator
+TOKEN_PATTERN = re.compile(r"\{[^}]*\}|;[^\n]*|[()]|\$\d+|[^\s{}();]+")
+MOVE_NUMBER_PATTERN = re.compile(r"\d+\.*")
+
+
+def game_result(game: Game):
+    result = game.check_if_game_ended()
+    if result == CHECKMATE:
+        return "0-1" if game.turn == WHITE else "1-0"
+    if result in DRAW_MESSAGES:
+        return "1/2-1/2"
+    return "*"
+
+
+def write_game(game: Game, tags=None):
+    """PGN of game, with the seven tag roster filled in from tags where given. The result is worked out from the final
+    position unless tags has one, for games that ended in a resignation or an agreed draw
+    """
+    if game.start_fen is None:
+        raise ValueError("Game does not know the position its moves were played from")
+
+    all_tags = {"Event": "?", "Site": "?", "Date": "????.??.??", "Round": "?", "White": "?", "Black": "?", "Result": game_result(game)}
+    all_tags.update(tags or {})
+    if game.start_fen != STARTING_FEN:
+        all_tags["SetUp"] = "1"
+        all_tags["FEN"] = game.start_fen
+
+    names = SEVEN_TAG_ROSTER + [name for name in all_tags if name not in SEVEN_TAG_ROSTER]
+    lines = [f'[{name} "{escape_tag(str(all_tags[name]))}"]' for name in names]
+    lines.append("")
+
+    # The moves were made on the game's own pieces, so they are played again from the start to get their notation
+    replay = Game.from_fen(game.start_fen)
+    tokens = []
+    for move in game.moves:
+        if replay.turn == WHITE:
+            tokens.append(f"{replay.fullmove_number}.")
+        elif not tokens:
+            tokens.append(f"{replay.fullmove_number}...")
+
+        packed = replay.find_legal_move(move.initial_loc.index, move.final_loc.index, move.promotion)
+        if packed is None:
+            raise ValueError(f"Move {len(replay.moves) + 1} of the game is illegal")
+        tokens.append(replay.san(packed))
+        replay.make_packed_move(packed)
+    tokens.append(all_tags["Result"])
+
+    line = ""
+    for token in tokens:
+        if line and len(line) + 1 + len(token) > LINE_LENGTH:
+            lines.append(line)
+            line = token
+        else:
+            line = f"{line} {token}" if line else token
+    lines.append(line)
+
+    return "\n".join(lines) + "\n"
+
+
+def escape_tag(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def parse_movetext(tags, movetext):
+    game = Game.from_fen(tags["FEN"]) if "FEN" in tags else Game()
+
+    depth = 0  # of the variation being skipped
+    for token in TOKEN_PATTERN.findall(movetext):
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth = max(depth - 1, 0)
+        elif depth or token[0] in "{;$" or token in RESULTS:
+            continue
+        else:
+            # Move numbers may be written right against the move, as in 1.e4
+            notation = MOVE_NUMBER_PATTERN.sub("", token, count=1) if token[0].isdigit() and not token.startswith("0-0") else token
+            if not notation:
+                continue
+
+            game.make_packed_move(game.parse_san(notation))
+
+            result = game.check_if_game_ended()
+            if result == CHECKMATE:
+                game.moves[-1].mate = True
+            elif game.is_in_check():
+                game.moves[-1].check = True
+
+    return game
+
+
+def read_games(file, skip_invalid=False):
+    """Yield (tags, Game) for each game in a PGN file, reading it a line at a time so that the file can be any size.
+
+    A game with a bad FEN tag or a move that cannot be played raises ValueError, or is left out when skip_invalid is set
+    """
+    tags = {}
+    movetext = []
+
+    def finish():
+        try:
+            return tags, parse_movetext(tags, "\n".join(movetext))
+        except Exception as error:
+            # Anything a malformed game makes go wrong, so that one bad game never ends a bulk import
+            if skip_invalid:
+                return None
+            raise ValueError(f"{error} in game {tags.get('White', '?')} - {tags.get('Black', '?')}, {tags.get('Date', '?')}") from error
+
+    for line in file:
+        line = line.strip()
+        if line.startswith("%"):
+            # Escaped line, for the use of other programs
+            continue
+
+        if line.startswith("["):
+            # Tags after moves start the next game
+            if movetext:
+                finished = finish()
+                if finished is not None:
+                    yield finished
+                tags = {}
+                movetext = []
+
+            for name, value in TAG_PATTERN.findall(line):
+                tags[name] = re.sub(r"\\(.)", r"\1", value)
+        elif line:
+            movetext.append(line)
+
+    if tags or movetext:
+        finished = finish()
+        if finished is not None:
+            yield finished
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay every game in a PGN file and report how fast they were read")
+    parser.add_argument("path", help="PGN file to read")
+    parser.add_argument("--skip-invalid", action="store_true", help="leave out games with moves that cannot be played")
+    parser.add_argument("--output", help="write the games back out to this file as PGN")
+    args = parser.parse_args()
+
+    games = 0
+    moves = 0
+    output = open(args.output, "w", encoding="utf-8") if args.output else None
+    start = time.perf_counter()
+    try:
+        with open(args.path, encoding="utf-8", errors="replace") as file:
+            for tags, game in read_games(file, args.skip_invalid):
+                games += 1
+                moves += len(game.moves)
+                if output is not None:
+                    output.write(write_game(game, tags) + "\n")
+    finally:
+        if output is not None:
+            output.close()
+    elapsed = time.perf_counter() - start
+
+    print(f"Games: {games}; Moves: {moves}; Time: {elapsed:.2f}s ({moves / max(elapsed, 1e-9):,.0f} moves/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+import struct
+
+from model import *
+
+# Bumped whenever a payload layout below changes, so mismatched clients and servers fail loudly instead of desyncing
+PROTOCOL_VERSION = 1
+
+# Moves between the FEN checkpoints that clients use to confirm they still agree with the server
+CHECKPOINT_INTERVAL = 16
+
+# "game_start" payload: version, the receiving player's color, followed by the starting position as FEN
+GAME_START = struct.Struct("!Bb")
+# "delta" payload: version, number of moves played including this one, packed move, whether the game goes on,
+# followed by a FEN checkpoint of the position after the move (empty when there is none)
+MOVE_DELTA = struct.Struct("!BIHB")
+# "move_error" payload: version, why the move was rejected, number of moves played, followed by the server's position
+# as FEN when the sender should resync to it (empty when there is nothing to resync)
+MOVE_ERROR = struct.Struct("!BBI")
+
+# "watch_start" payload for spectators: version, number of moves, lengths of the white and black usernames, followed by
+# the moves packed, the usernames, and the FEN the moves were played from
+WATCH_START = struct.Struct("!BHHH")
+# "game_over" payload for spectators: version, winning color or 0 for a draw, followed by how the game ended
+GAME_OVER = struct.Struct("!Bb")
+
+# Reasons a move is rejected
+MALFORMED_MOVE = 1
+NOT_YOUR_TURN = 2
+ILLEGAL_MOVE = 3
+
+MOVE_ERROR_MESSAGES = {
+    MALFORMED_MOVE: "The server could not read that move",
+    NOT_YOUR_TURN: "It is not your turn",
+    ILLEGAL_MOVE: "That move is illegal",
+}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def check_version(version):
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}, expected {PROTOCOL_VERSION}")
+
+
+def encode_game_start(game: Game, color):
+    return GAME_START.pack(PROTOCOL_VERSION, color) + bytes(game.to_fen(), "utf-8")
+
+
+def decode_game_start(data: bytes):
+    version, color = GAME_START.unpack_from(data)
+    check_version(version)
+
+    return Game.from_fen(data[GAME_START.size:].decode("utf-8")), color
+
+
+def encode_move_delta(sequence, packed, in_game, checkpoint=""):
+    return MOVE_DELTA.pack(PROTOCOL_VERSION, sequence, packed, in_game) + bytes(checkpoint, "utf-8")
+
+
+def decode_move_delta(data: bytes):
+    version, sequence, packed, in_game = MOVE_DELTA.unpack_from(data)
+    check_version(version)
+
+    return sequence, packed, bool(in_game), data[MOVE_DELTA.size:].decode("utf-8")
+
+
+def apply_move_delta(game: Game, data: bytes, notate=False):
+    """Bring game up to date with a move delta, returning the game to use from now on and whether it goes on.
+
+    With notate the move's standard algebraic notation is kept on it, for clients that show a move list
+    """
+    sequence, packed, in_game, checkpoint = decode_move_delta(data)
+
+    if sequence == len(game.moves) + 1:
+        if notate:
+            game.make_notated_move(packed)
+        else:
+            game.make_packed_move(packed)
+
+        result = game.check_if_game_ended()
+        if result == CHECKMATE:
+            game.moves[-1].mate = True
+        elif game.is_in_check():
+            game.moves[-1].check = True
+    elif sequence == len(game.moves) and sequence > 0:
+        # The server echoing a move this client already played locally
+        initial_index, final_index, _ = unpack_move(packed)
+        last_move = game.moves[-1]
+        if (last_move.initial_loc.index, last_move.final_loc.index, last_move.promotion) != (initial_index, final_index, packed_promotion(packed)):
+            raise ProtocolError(f"Move {sequence} from the server does not match the move played locally")
+    else:
+        raise ProtocolError(f"Move {sequence} from the server does not follow move {len(game.moves)}")
+
+    if checkpoint and game.to_fen() != checkpoint:
+        # Out of step with the server: take its position
+        game = resync(game, checkpoint, game.moves, game.position_counts)
+
+    return game, in_game
+
+
+def encode_move_error(reason, sequence, position=""):
+    return MOVE_ERROR.pack(PROTOCOL_VERSION, reason, sequence) + bytes(position, "utf-8")
+
+
+def decode_move_error(data: bytes):
+    version, reason, sequence = MOVE_ERROR.unpack_from(data)
+    check_version(version)
+
+    return reason, sequence, data[MOVE_ERROR.size:].decode("utf-8")
+
+
+def apply_move_error(game: Game, data: bytes):
+    """Take back a move the server rejected, returning the game to use from now on and why the move was rejected"""
+    reason, sequence, position = decode_move_error(data)
+
+    if position:
+        # The move was played locally first, so go back to the server's position, keeping the moves it agrees with
+        position_counts = dict(game.position_counts)
+        if len(game.moves) > sequence:
+            # and forgetting the position the rejected move reached, which the game never did
+            position_counts[game.board.zobrist_key] -= 1
+            if not position_counts[game.board.zobrist_key]:
+                del position_counts[game.board.zobrist_key]
+        game = resync(game, position, game.moves[:sequence], position_counts)
+
+    return game, reason
+
+
+def resync(game: Game, fen, moves, position_counts):
+    """Game at the server's position fen, keeping what a FEN cannot hold: the moves for display, where the game started
+    and how often each position has been seen, which repetition draws are worked out from. The FEN has the halfmove clock
+    """
+    synced = Game.from_fen(fen)
+    synced.moves = moves
+    synced.start_fen = game.start_fen
+    synced.position_counts = dict(position_counts)
+    synced.position_counts.setdefault(synced.board.zobrist_key, 1)
+
+    return synced
+
+
+def encode_watch_start(start_fen, packed_moves, white_username, black_username):
+    white = bytes(white_username, "utf-8")
+    black = bytes(black_username, "utf-8")
+    header = WATCH_START.pack(PROTOCOL_VERSION, len(packed_moves), len(white), len(black))
+
+    return header + struct.pack(f"!{len(packed_moves)}H", *packed_moves) + white + black + bytes(start_fen, "utf-8")
+
+
+def decode_watch_start(data: bytes):
+    """Rebuild the game a spectator has started watching, returning (game, white username, black username)"""
+    version, move_count, white_length, black_length = WATCH_START.unpack_from(data)
+    check_version(version)
+
+    offset = WATCH_START.size
+    packed_moves = struct.unpack_from(f"!{move_count}H", data, offset)
+    offset += 2 * move_count
+    white_username = data[offset:offset + white_length].decode("utf-8")
+    offset += white_length
+    black_username = data[offset:offset + black_length].decode("utf-8")
+    offset += black_length
+
+    # Moves are played again rather than sent as a position, so that later deltas number on from them
+    game = Game.from_fen(data[offset:].decode("utf-8"))
+    for packed in packed_moves:
+        game.make_packed_move(packed)
+
+        result = game.check_if_game_ended()
+        if result == CHECKMATE:
+            game.moves[-1].mate = True
+        elif game.is_in_check():
+            game.moves[-1].check = True
+
+    return game, white_username, black_username
+
+
+def encode_game_over(winner, reason):
+    return GAME_OVER.pack(PROTOCOL_VERSION, winner) + bytes(reason, "utf-8")
+
+
+def decode_game_over(data: bytes):
+    version, winner = GAME_OVER.unpack_from(data)
+    check_version(version)
+
+    return winner, data[GAME_OVER.size:].decode("utf-8")
@@ -0,0 +1,86 @@
+import random
+import threading
+from typing import List
+
+MAX_ROOM_CODE = 9999
+
+
+class RoomRegistry:
+    """Rooms by code, split into those waiting for players and those being played, and the codes free for new rooms.
+
+    A room is anything with a code attribute. Every method takes the lock, so the registry can be shared with other
+    threads, and all of them take constant time apart from listing codes
+    """
+
+    def __init__(self, max_code=MAX_ROOM_CODE):
+        self.lock = threading.Lock()
+        self.unfilled = {}
+        self.filled = {}
+        # Free codes in no particular order, and the position of each in that list, so any one can be taken out at once
+        self.free_codes = list(range(1, max_code + 1))
+        self.free_positions = {code: position for position, code in enumerate(self.free_codes)}
+
+    def take_code(self, code):
+        # Callers hold the lock
+        position = self.free_positions.pop(code, None)
+        if position is None:
+            return
+
+        last = self.free_codes.pop()
+        if last != code:
+            self.free_codes[position] = last
+            self.free_positions[last] = position
+
+    def new_code(self):
+        """Reserve a random free code for a new room, or return None when every code is taken"""
+        with self.lock:
+            if not self.free_codes:
+                return None
+
+            code = random.choice(self.free_codes)
+            self.take_code(code)
+            return code
+
+    def add(self, room, filled=False):
+        # Rooms may bring their own code, as saved games and rooms handed to a worker do
+        with self.lock:
+            self.take_code(room.code)
+            (self.filled if filled else self.unfilled)[room.code] = room
+
+    def fill(self, code):
+        with self.lock:
+            self.filled[code] = self.unfilled.pop(code)
+
+    def get_unfilled(self, code):
+        with self.lock:
+            return self.unfilled.get(code)
+
+    def get_filled(self, code):
+        with self.lock:
+            return self.filled.get(code)
+
+    def remove(self, code):
+        """Forget the room with code and free the code for a new room, returning the room or None if there was none"""
+        with self.lock:
+            room = self.unfilled.pop(code, None)
+            if room is None:
+                room = self.filled.pop(code, None)
+            if room is None:
+                return None
+
+            self.free_positions[code] = len(self.free_codes)
+            self.free_codes.append(code)
+
+        return room
+
+    def unfilled_codes(self) -> List[int]:
+        with self.lock:
+            return list(self.unfilled)
+
+    def filled_codes(self) -> List[int]:
+        with self.lock:
+            return list(self.filled)
+
+    def codes(self) -> List[int]:
+        with self.lock:
+            return list(self.unfilled) + list(self.filled)
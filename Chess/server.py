@@ -1,173 +1,578 @@
+import argparse
+import asyncio
+import collections
+import multiprocessing
 import pickle
-import random
+import signal
 import socket
+import struct
 import sys
-import threading
 import time
-from typing import Tuple
-
-import select
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Tuple
 
+from codec import *
+from engine import Engine
+from metrics import *
 from model import *
+from protocol import *
+from registry import *
+from storage import *
+
+
+BACKLOG = 4096
+HANDOFF_SIZE = 65536  # largest pickled (username, action, code) a worker accepts with a handed-off socket
+# Sent by a worker to the front-end whenever one of its rooms changes: room code, players it still waits for, or
+# ROOM_CLOSED once it is gone
+ROOM_UPDATE = struct.Struct("!Ii")
+ROOM_CLOSED = -1
+SPECTATOR_FLUSH_TIMEOUT = 5.0  # seconds a spectator gets to take what is left in its buffer once the room closes
+BOT_EXIT_TIMEOUT = 5.0  # seconds a computer player gets to notice its room has closed before it is terminated
+
+rooms = RoomRegistry()
+front_end = None  # in a worker, the control socket that room updates go back to the front-end on
+background_tasks = set()
+validator = None  # MoveValidator when moves are checked in a process pool, otherwise they are checked inline
+game_log = None  # GameLog when games are saved to disk, otherwise they only live in memory
+bot_codes = set()  # codes of the rooms being played against the computer, each of which has a process searching
+max_bots = 4  # most rooms played against the computer at once, as each one keeps a CPU busy while it thinks
+metrics = Metrics()
+metrics.describe("chess_connections", "gauge", "Client connections open in this process")
+metrics.describe("chess_rooms", "gauge", "Rooms waiting for players and rooms being played", label="state")
+metrics.describe("chess_spectators", "gauge", "Spectators watching rooms in this process")
+metrics.describe("chess_spectator_overflows_total", "counter", "Spectators whose buffer filled up, by what was done about it",
+                 label="policy")
+metrics.describe("chess_moves_total", "counter", "Moves played")
+metrics.describe("chess_moves_rejected_total", "counter", "Moves rejected", label="reason")
+metrics.describe("chess_move_validation_seconds", "histogram",
+                 "Time to look a move up and play it, including the round trip to the validation pool when it is used",
+                 label="path")
+metrics.describe("chess_game_end_check_seconds", "histogram",
+                 "Time spent in check_if_game_ended after each move, which finds the legal moves when nothing else has")
+metrics.describe("chess_bytes_sent_total", "counter", "Bytes sent to clients, frame headers included", label="type")
+metrics.describe("chess_bytes_received_total", "counter", "Bytes received from clients, frame headers included", label="type")
+
+metrics.read_gauge("chess_rooms", lambda: len(rooms.unfilled_codes()), "unfilled")
+metrics.read_gauge("chess_rooms", lambda: len(rooms.filled_codes()), "filled")
+metrics.describe("chess_bot_rooms", "gauge", "Rooms being played against the computer")
+metrics.read_gauge("chess_bot_rooms", lambda: len(bot_codes))
+
+REJECTION_LABELS = {MALFORMED_MOVE: "malformed", NOT_YOUR_TURN: "not_your_turn", ILLEGAL_MOVE: "illegal"}
+
+# Frames buffered for each spectator, and what happens to one whose buffer fills up: "resync" swaps what it has waiting
+# for the whole game so far, "disconnect" drops it
+spectating = {"max_frames": 64, "overflow": "resync"}
+
+
+def count_received(data: bytes, type_):
+    metrics.inc("chess_bytes_received_total", FRAME_HEADER.size + len(data), type_ or "text")
+
+
+async def read_message(reader: asyncio.StreamReader) -> Tuple[bytes, str]:
+    length, type_ = unpack_header(await reader.readexactly(FRAME_HEADER.size))
+    data = await reader.readexactly(length)
+    count_received(data, type_)
+
+    return data, type_
+
+
+class Connection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.connected = True
+
+    async def send(self, data: bytes, type_=""):
+        await self.send_frame(pack_message(data, type_))
+
+    async def send_frame(self, frame: bytes):
+        # Messages to a player who has gone are dropped, so the room can still finish with the other one
+        if not self.connected:
+            return
+
+        try:
+            self.writer.write(frame)
+            metrics.inc("chess_bytes_sent_total", len(frame), frame_type(frame) or "text")
+            await self.writer.drain()
+        except ConnectionError:
+            self.connected = False
+
+    async def recv(self) -> Tuple[bytes, str]:
+        # Once a bad frame is seen nothing after it can be trusted to line up with a message, so stop reading
+        if not self.connected:
+            return b"", "disconnect"
+
+        try:
+            return await read_message(self.reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.connected = False
+            return b"", "disconnect"
+
+    def close(self):
+        self.connected = False
+        self.writer.close()
+
+    async def wait_closed(self):
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+
+class SocketConnection:
+    # Reads straight from the socket and never past the end of the current message, so that the front-end can
+    # hand the socket to a worker without leaving anything the player sent behind in a buffer
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.connected = True
+        self.header = bytearray(FRAME_HEADER.size)  # reused for every message
+
+    async def send(self, data: bytes, type_=""):
+        if not self.connected:
+            return
+
+        try:
+            frame = pack_message(data, type_)
+            await asyncio.get_running_loop().sock_sendall(self.sock, frame)
+            metrics.inc("chess_bytes_sent_total", len(frame), type_ or "text")
+        except ConnectionError:
+            self.connected = False
 
+    async def recv_exactly_into(self, buffer):
+        loop = asyncio.get_running_loop()
+        view = memoryview(buffer)
+        while view:
+            received = await loop.sock_recv_into(self.sock, view)
+            if not received:
+                raise ConnectionError("Connection closed")
+            view = view[received:]
 
-def send(sock: socket.socket, data: bytes, type_=""):
-    header = {
-        "type": type_,
-        "length": len(data)
-    }
+    async def recv(self) -> Tuple[bytearray, str]:
+        if not self.connected:
+            return bytearray(), "disconnect"
 
-    pickled_header = pickle.dumps(header)
+        try:
+            await self.recv_exactly_into(self.header)
+            length, type_ = unpack_header(self.header)
 
-    assert len(pickled_header) <= HEADER, "Length of un-padded header is greater than maximum header size"
+            data = bytearray(length)
+            await self.recv_exactly_into(data)
+            count_received(data, type_)
+            return data, type_
+        except ConnectionError:
+            self.connected = False
+            return bytearray(), "disconnect"
 
-    pickled_header += b' ' * (HEADER - len(pickled_header))
+    def close(self):
+        self.connected = False
+        self.sock.close()
 
-    sock.sendall(pickled_header)
-    sock.sendall(data)
 
+class ValidationUnavailable(Exception):
+    pass
 
-def recv(sock: socket.socket) -> Tuple[bytes, str]:
-    pickled_header = b''
-    received_length = 0
 
-    while HEADER - received_length > 0:
-        pickled_header += sock.recv(HEADER - received_length)
-        received_length = len(pickled_header)
+def parse_move(move_string: str):
+    """Read a player's move as (initial index, final index, promotion), or return None if it is not a move at all"""
+    initial_loc = SQUARES_BY_NAME.get(move_string[:2].lower())
+    final_loc = SQUARES_BY_NAME.get(move_string[2:4].lower())
+    if initial_loc is None or final_loc is None:
+        return None
 
-    header = pickle.loads(pickled_header)
-    data_len = header["length"]
-    data_type = header["type"]
-    received_length = 0
+    # Clients send the promoted piece type after the squares, or str(None) when there is none
+    promotion_string = move_string[4:]
+    if promotion_string in ["", "None"]:
+        promotion = None
+    elif promotion_string in [str(KNIGHT), str(BISHOP), str(ROOK), str(QUEEN)]:
+        promotion = int(promotion_string)
+    else:
+        return None
 
-    chunks = []
-    while data_len - received_length > 0:
-        chunk = sock.recv(data_len - received_length)
-        chunks.append(chunk)
-        received_length += len(chunk)
+    return initial_loc.index, final_loc.index, promotion
 
-    data = b''.join(chunks)
 
-    return data, data_type
+def status_after_move(fen: str, packed):
+    # Runs in the validation pool, where only the position travels between processes
+    game = Game.from_fen(fen)
+    game.make_packed_move(packed)
+    king = game.board.white_king if game.turn == WHITE else game.board.black_king
+
+    return game.generate_packed_moves_for(game.turn), game.is_targeted(-game.turn, king.square)
+
+
+class MoveValidator:
+    """Works out the legal moves after each move in a pool of processes, so that slow positions neither stall the event
+    loop nor hold the GIL.
+
+    At most max_pending moves are in the pool at once and each one gets timeout seconds. When either limit is hit
+    evaluate raises ValidationUnavailable, and the room works them out itself
+    """
+
+    def __init__(self, workers=None, max_pending=256, timeout=1.0):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+        self.executor = self.create_executor()
+
+    def create_executor(self):
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def replace_executor(self, broken: ProcessPoolExecutor):
+        # A pool process died, which breaks the whole pool, so start a new one for later moves. Every job that was in
+        # the broken pool fails at once, and only the first room to notice replaces it
+        if self.executor is broken:
+            self.executor = self.create_executor()
+            broken.shutdown(wait=False, cancel_futures=True)
+
+    def release(self):
+        self.pending -= 1
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    async def evaluate(self, game: Game, packed):
+        # (legal packed moves, in check) for the position after the move
+        if self.pending >= self.max_pending:
+            raise ValidationUnavailable("Too many moves waiting for validation")
+
+        loop = asyncio.get_running_loop()
+        executor = self.executor
+        try:
+            job = executor.submit(status_after_move, game.to_fen(), packed)
+        except BrokenProcessPool:
+            self.replace_executor(executor)
+            raise ValidationUnavailable("Validation pool had to be restarted")
+
+        # Count the job until the pool is done with it, even if we stop waiting for it first
+        self.pending += 1
+        job.add_done_callback(lambda _: loop.call_soon_threadsafe(self.release))
+
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(job), self.timeout)
+        except asyncio.TimeoutError:
+            raise ValidationUnavailable("Validation timed out")
+        except BrokenProcessPool:
+            self.replace_executor(executor)
+            raise ValidationUnavailable("Validation pool had to be restarted")
+
+
+class Spectator:
+    """A read-only connection to a room. Frames are packed once for every spectator, then wait in a buffer of at most
+    max_frames while this one's socket is slow, so that it never holds up the game or the other spectators
+    """
+
+    def __init__(self, connection: Connection, max_frames=64):
+        self.connection = connection
+        self.max_frames = max_frames
+        self.frames = collections.deque()  # None once the room has closed, after the last frame
+        self.ready = asyncio.Event()
+        self.writer = asyncio.create_task(self.write_frames())
+
+    def offer(self, frame: bytes):
+        # False when the buffer is full, leaving the room to decide what to do with a spectator that fell behind
+        if len(self.frames) >= self.max_frames:
+            return False
+
+        self.frames.append(frame)
+        self.ready.set()
+        return True
+
+    def replace(self, frames):
+        self.frames.clear()
+        self.frames.extend(frames)
+        self.ready.set()
+
+    def finish(self):
+        # Closes once the buffer has been sent, or after SPECTATOR_FLUSH_TIMEOUT if the socket never takes it
+        self.frames.append(None)
+        self.ready.set()
+        asyncio.get_running_loop().call_later(SPECTATOR_FLUSH_TIMEOUT, self.close)
+
+    async def write_frames(self):
+        try:
+            while self.connection.connected:
+                await self.ready.wait()
+                self.ready.clear()
+
+                while self.frames:
+                    frame = self.frames.popleft()
+                    if frame is None:
+                        return
+                    await self.connection.send_frame(frame)
+        finally:
+            self.connection.close()
+
+    def close(self):
+        self.writer.cancel()
+        self.connection.close()
 
 
 class Room:
     def __init__(self, host, code, host_username="Guest"):
-        self.player1: socket.socket = host
-        self.player2: socket.socket = None
+        self.player1: Connection = host
+        self.player2: Connection = None
         self.player1_username = host_username
         self.player2_username = "Guest"
         self.code: int = code
+        self.messages = asyncio.Queue()  # (player, data, type) from both players, in the order they arrived
+        self.logged = True  # whether the games played here go in the game log
+        self.saved_game: Optional[SavedGame] = None  # game from the game log to finish before starting new ones
+        self.spectators = set()
+        self.closed = False
+        self.waiting: Optional[asyncio.Task] = None  # watches the first player for leaving before anyone joins
+        # The game being played, as spectators are sent it: where it started, the moves since and who is playing
+        self.game: Optional[Game] = None
+        self.packed_moves = []
+        self.white_username = None
+        self.black_username = None
 
-    def play(self):
+    def wait_for_player(self):
+        self.waiting = asyncio.create_task(self.watch_first_player())
+
+    async def watch_first_player(self):
+        # Nothing is read from the first player while they wait, so this is how one who gives up is noticed
+        while (await self.player1.recv())[1] != "disconnect":
+            pass
+
+        self.player1.close()
+        self.waiting = None
+        if self.saved_game is not None:
+            # Saved games are kept for their players, so the room goes back to waiting for both of them
+            self.player1 = None
+            self.player1_username = "Guest"
+            report_room(self.code, 2)
+        else:
+            rooms.remove(self.code)
+            report_room(self.code, ROOM_CLOSED)
+
+    def stop_waiting(self):
+        # Cancelling the read loses nothing, since readexactly only takes data off the stream once all of it is there
+        if self.waiting is not None:
+            self.waiting.cancel()
+            self.waiting = None
+
+    async def read_messages(self, player: Connection):
+        while True:
+            data, data_type = await player.recv()
+            await self.messages.put((player, data, data_type))
+
+            if data_type == "disconnect":
+                break
+
+    async def play_move(self, game: Game, packed):
+        # Moves here are already known to be legal. The legal moves worked out for the position after it are cached in
+        # the game, which is what the next move is looked up in
+        if validator is not None:
+            try:
+                packed_moves, in_check = await validator.evaluate(game, packed)
+            except ValidationUnavailable:
+                pass
+            else:
+                game.make_packed_move(packed)
+                game.set_status(packed_moves, in_check)
+                return "pool"
+
+        game.make_packed_move(packed)
+        return "inline"
+
+    async def reject_move(self, player: Connection, game: Game, reason):
+        # Only moves the player could have played on their own board come with the position to resync to, so that
+        # malformed ones stay as cheap to reject as they were to read
+        position = "" if reason == MALFORMED_MOVE else game.to_fen()
+        metrics.inc("chess_moves_rejected_total", 1, REJECTION_LABELS[reason])
+        await player.send(encode_move_error(reason, len(game.moves), position), type_="move_error")
+
+    async def watch(self, connection: Connection):
+        if self.closed:
+            connection.close()
+            return
+
+        spectator = Spectator(connection, spectating["max_frames"])
+        self.spectators.add(spectator)
+        metrics.inc("chess_spectators")
+        if self.game is not None:
+            spectator.offer(self.watch_start_frame())
+
+        # Spectators only listen, so anything they send is dropped. Reading is how one that leaves is noticed
+        while (await connection.recv())[1] != "disconnect":
+            pass
+
+        self.spectators.discard(spectator)
+        spectator.close()
+        metrics.inc("chess_spectators", -1)
+
+    def watch_start_frame(self):
+        watch_start = encode_watch_start(self.game.start_fen, self.packed_moves, self.white_username, self.black_username)
+        return pack_message(watch_start, "watch_start")
+
+    def publish(self, frame: bytes, in_snapshot=True):
+        """Queue a frame, packed once, for every spectator.
+
+        A spectator with a full buffer has fallen too far behind to catch up frame by frame. It is either dropped, or
+        sent the game so far in place of everything it had waiting, followed by the frame unless in_snapshot says the
+        game so far already covers it
+        """
+        snapshot = None
+        for spectator in list(self.spectators):
+            if spectator.offer(frame):
+                continue
+
+            metrics.inc("chess_spectator_overflows_total", 1, spectating["overflow"])
+            if spectating["overflow"] == "disconnect":
+                self.spectators.discard(spectator)
+                spectator.close()
+                continue
+
+            if snapshot is None:
+                snapshot = self.watch_start_frame()
+            spectator.replace([snapshot] if in_snapshot else [snapshot, frame])
+
+    def seat_saved_players(self):
+        # Players coming back to a saved game keep their colors, as far as their usernames tell them apart
+        white, black = self.saved_game.white_username, self.saved_game.black_username
+        if self.player2_username == white != self.player1_username or self.player1_username == black != self.player2_username:
+            self.player1, self.player2 = self.player2, self.player1
+            self.player1_username, self.player2_username = self.player2_username, self.player1_username
+
+    async def play(self):
+        readers = [asyncio.create_task(self.read_messages(player)) for player in [self.player1, self.player2]]
+        try:
+            await self.play_games()
+        finally:
+            for reader in readers:
+                reader.cancel()
+            self.player1.close()
+            self.player2.close()
+
+            self.closed = True
+            for spectator in self.spectators:
+                spectator.finish()
+            self.spectators.clear()
+
+            rooms.remove(self.code)
+            report_room(self.code, ROOM_CLOSED)
+
+    async def play_games(self):
         in_room = True
         players = {"WHITE": self.player1, "BLACK": self.player2}
         colors = {self.player1: "WHITE", self.player2: "BLACK"}
         other_player = {self.player1: self.player2, self.player2: self.player1}
+        usernames = {self.player1: self.player1_username, self.player2: self.player2_username}
 
         while in_room:
             game = Game()
+            if self.saved_game is not None:
+                # Numbering the moves afresh from the saved position, just as the players will
+                game = Game.from_fen(self.saved_game.position())
+                self.saved_game = None
             in_game = True
-            turn = WHITE
+            ending = None  # (winning color or 0 for a draw, how the game ended) for spectators
 
-            send(self.player1, bytes(self.player2_username, "utf-8"), type_="opp_name")
-            send(self.player2, bytes(self.player1_username, "utf-8"), type_="opp_name")
+            self.game = game
+            self.packed_moves = []
+            self.white_username = usernames[players["WHITE"]]
+            self.black_username = usernames[players["BLACK"]]
 
-            p1_game_state = {
-                "in_game": in_game,
-                "game": game,
-                "player_color": colors[self.player1],
-                "turn_color": "WHITE"
-            }
+            if game_log is not None and self.logged:
+                game_log.start_game(self.code, game, usernames[players["WHITE"]], usernames[players["BLACK"]])
 
-            p2_game_state = {
-                "in_game": in_game,
-                "game": game,
-                "player_color": colors[self.player2],
-                "turn_color": "WHITE"
-            }
+            await self.player1.send(bytes(self.player2_username, "utf-8"), type_="opp_name")
+            await self.player2.send(bytes(self.player1_username, "utf-8"), type_="opp_name")
 
-            send(self.player1, pickle.dumps(p1_game_state), type_="gamestate")
-            send(self.player2, pickle.dumps(p2_game_state), type_="gamestate")
+            # Players get the starting position once, then only the moves played from it
+            for player in [self.player1, self.player2]:
+                color = WHITE if colors[player] == "WHITE" else BLACK
+                await player.send(encode_game_start(game, color), type_="game_start")
+            self.publish(self.watch_start_frame())
 
             while in_game:
-                turn_color = "WHITE" if turn == WHITE else "BLACK"
-
-                readable, _, _ = select.select([self.player1, self.player2], [], [], 1)
-
-                for player_sock in readable:
-                    data, data_type = recv(player_sock)
-                    if data_type == "move":
-                        # Get and apply move
-                        move_string = data.decode("utf-8").lower()
-                        square_to_move_from = move_string[:2]
-                        square_to_move_to = move_string[2:4]
-
-                        promotion_value = None
-                        if len(move_string) == 5:
-                            promotion_value = int(move_string[4])
-
-                        move = Move(
-                            initial_loc=Square.get_square(square_to_move_from),
-                            final_loc=Square.get_square(square_to_move_to),
-                            piece_moved=game.board.get(square_to_move_from),
-                            piece_captured=game.board.get(square_to_move_to),
-                            promotion=promotion_value
-                        )
-                        move = game.correct_en_passant(move)
-                        game.move(move)
-
-                        turn *= -1
-                        turn_color = "WHITE" if turn == WHITE else "BLACK"
-
-                        if game.check_if_game_ended() == CHECKMATE:
-                            game.moves[-1].mate = True
-                        elif turn == WHITE:
-                            if game.is_targeted(WHITE, game.board.black_king.square, check_if_exposes_king=False):
-                                game.moves[-1].check = True
-                        elif turn == BLACK:
-                            if game.is_targeted(BLACK, game.board.white_king.square, check_if_exposes_king=False):
-                                game.moves[-1].check = True
-
-                        if game.check_if_game_ended() == CHECKMATE or game.check_if_game_ended() == STALEMATE:
-                            in_game = False
+                player, data, data_type = await self.messages.get()
 
-                        p1_game_state = {
-                            "in_game": in_game,
-                            "game": game,
-                            "player_color": colors[self.player1],
-                            "turn_color": turn_color
-                        }
-
-                        p2_game_state = {
-                            "in_game": in_game,
-                            "game": game,
-                            "player_color": colors[self.player2],
-                            "turn_color": turn_color
-                        }
-
-                        send(self.player1, pickle.dumps(p1_game_state), type_="gamestate")
-                        send(self.player2, pickle.dumps(p2_game_state), type_="gamestate")
-                    elif data_type == "draw_offer":
-                        send(other_player[player_sock], bytes("draw_offer", "utf-8"), type_="draw_offer")
-                    elif data_type == "draw_accept":
-                        send(other_player[player_sock], bytes("draw_accept", "utf-8"), type_="draw_accept")
-                        in_game = False
-                    elif data_type == "draw_reject":
-                        send(other_player[player_sock], bytes("draw_reject", "utf-8"), type_="draw_reject")
-                    elif data_type == "resign":
-                        send(other_player[player_sock], bytes("resign", "utf-8"), type_="resign")
+                if data_type == "move":
+                    received = time.perf_counter()
+
+                    # Rejected moves only cost a dictionary lookup in the legal moves cached for this position
+                    if colors[player] != ("WHITE" if game.turn == WHITE else "BLACK"):
+                        await self.reject_move(player, game, NOT_YOUR_TURN)
+                        continue
+
+                    squares = parse_move(data.decode("utf-8", errors="replace"))
+                    if squares is None:
+                        await self.reject_move(player, game, MALFORMED_MOVE)
+                        continue
+
+                    packed = game.find_legal_move(*squares)
+                    if packed is None:
+                        await self.reject_move(player, game, ILLEGAL_MOVE)
+                        continue
+
+                    path = await self.play_move(game, packed)
+                    self.packed_moves.append(packed)
+                    checked = time.perf_counter()
+                    metrics.observe("chess_move_validation_seconds", checked - received, path)
+                    metrics.inc("chess_moves_total")
+
+                    result = game.check_if_game_ended()
+                    metrics.observe("chess_game_end_check_seconds", time.perf_counter() - checked)
+                    if result == CHECKMATE:
+                        game.moves[-1].mate = True
+                        ending = (-game.turn, "Checkmate")
+                    elif game.is_in_check():
+                        game.moves[-1].check = True
+
+                    if result in DRAW_MESSAGES:
+                        ending = (0, DRAW_MESSAGES[result])
+
+                    if result != GAME_IN_PLAY:
                         in_game = False
 
-            p1_resp, _ = recv(self.player1)
-            p2_resp, _ = recv(self.player2)
-            p1_resp = p1_resp.decode("utf-8").lower()
-            p2_resp = p2_resp.decode("utf-8").lower()
+                    checkpoint = ""
+                    if len(game.moves) % CHECKPOINT_INTERVAL == 0 or not in_game:
+                        checkpoint = game.to_fen()
+
+                    if game_log is not None and self.logged:
+                        game_log.record_move(self.code, len(game.moves), packed, checkpoint)
 
-            if p1_resp == p2_resp == "y":
+                    # Packed once, however many are watching
+                    frame = pack_message(encode_move_delta(len(game.moves), packed, in_game, checkpoint), "delta")
+                    await self.player1.send_frame(frame)
+                    await self.player2.send_frame(frame)
+                    self.publish(frame)
+                elif data_type == "draw_offer":
+                    await other_player[player].send(bytes("draw_offer", "utf-8"), type_="draw_offer")
+                elif data_type == "draw_accept":
+                    await other_player[player].send(bytes("draw_accept", "utf-8"), type_="draw_accept")
+                    ending = (0, "Draw agreed!")
+                    in_game = False
+                elif data_type == "draw_reject":
+                    await other_player[player].send(bytes("draw_reject", "utf-8"), type_="draw_reject")
+                elif data_type in ["resign", "disconnect"]:
+                    # Leaving mid-game counts as resigning
+                    await other_player[player].send(bytes("resign", "utf-8"), type_="resign")
+                    ending = (BLACK if colors[player] == "WHITE" else WHITE, f"{colors[player]} resigned!")
+                    in_game = False
+
+            self.publish(pack_message(encode_game_over(*ending), "game_over"), in_snapshot=False)
+
+            if game_log is not None and self.logged:
+                game_log.end_game(self.code)
+
+            # A player who has left cannot answer, so they are taken to have said no
+            responses = {player: "n" for player in [self.player1, self.player2] if not player.connected}
+            while len(responses) < 2:
+                player, data, data_type = await self.messages.get()
+                if data_type == "disconnect":
+                    responses[player] = "n"
+                elif data_type == "":
+                    responses[player] = data.decode("utf-8", errors="replace").lower()
+                # anything else was sent for the game that just ended, so it is dropped
+
+            if responses[self.player1] == responses[self.player2] == "y":
                 # Rematch accepted
-                send(self.player1, bytes("Rematch accepted!", "utf-8"))
-                send(self.player2, bytes("Rematch accepted!", "utf-8"))
+                await self.player1.send(bytes("Rematch accepted!", "utf-8"))
+                await self.player2.send(bytes("Rematch accepted!", "utf-8"))
 
                 w = players["WHITE"]
                 b = players["BLACK"]
@@ -180,77 +585,585 @@ class Room:
                 colors[self.player2] = p1
             else:
                 # Rematch denied
-                send(self.player1, bytes("Rematch denied!", "utf-8"))
-                send(self.player2, bytes("Rematch denied!", "utf-8"))
+                await self.player1.send(bytes("Rematch denied!", "utf-8"))
+                await self.player2.send(bytes("Rematch denied!", "utf-8"))
                 in_room = False
 
     def __repr__(self):
         return f"{self.player1}; {self.player2}; {self.code}"
 
 
-def handle_new_connection(csock, addr):
-    username_bytes, _ = recv(csock)
-    username = username_bytes.decode("utf-8")
+class Bot:
+    username = "Computer"
+
+    def __init__(self, sock, time_limit=1.0, table_size_mb=8):
+        self.sock: socket.socket = sock
+        self.engine = Engine(time_limit=time_limit, table_size_mb=table_size_mb)
+
+    def play(self):
+        try:
+            self.play_games()
+        except ConnectionError:
+            # The room went away without denying a rematch
+            pass
+        finally:
+            self.sock.close()
+
+    def play_games(self):
+        in_room = True
+        while in_room:
+            in_game = True
+            game = None
+            color = None
+            while in_game:
+                data, data_type = recv(self.sock)
+                if data_type in ["game_start", "delta", "move_error"]:
+                    if data_type == "game_start":
+                        game, color = decode_game_start(data)
+                    elif data_type == "delta":
+                        game, in_game = apply_move_delta(game, data)
+                    else:
+                        game, _ = apply_move_error(game, data)
+
+                    if in_game and game.turn == color:
+                        move = self.engine.search(game)
+                        if move is None:
+                            # Nothing to play, so the game is over as far as the computer can tell
+                            send(self.sock, bytes("resign", "utf-8"), type_="resign")
+                            in_game = False
+                            continue
+
+                        move_string = move.initial_loc.convert_to_name() + move.final_loc.convert_to_name() + str(move.promotion)
+                        send(self.sock, bytes(move_string, "utf-8"), type_="move")
+                elif data_type == "draw_offer":
+                    send(self.sock, bytes("draw_reject", "utf-8"), type_="draw_reject")
+                elif data_type in ["draw_accept", "resign"]:
+                    in_game = False
+
+            # The computer always accepts a rematch, so the room stays open for as long as the player wants
+            send(self.sock, bytes("y", "utf-8"))
+
+            msg, _ = recv(self.sock)
+            if msg.decode("utf-8") == "Rematch denied!":
+                in_room = False
 
-    response, _ = recv(csock)
-    response = response.decode("utf-8").lower()
 
-    if response == "create":
-        new_room_code = random.choice([x for x in range(1, 10000) if x not in [room.code for room in rooms]])
-        new_room = Room(csock, new_room_code, host_username=username)
-        unfilled.append(new_room)
-        rooms.append(new_room)
-        send(csock, bytes(f"Your room code is {new_room_code}", "utf-8"))
-    elif response == "join":
+def run_bot(sock: socket.socket):
+    # The engine is made here rather than in the server, so that its tables never have to be pickled
+    Bot(sock).play()
+
+
+async def play_against_bot(room: Room, bot_process: multiprocessing.Process):
+    try:
+        await room.play()
+    finally:
+        bot_codes.discard(room.code)
+
+        # The computer leaves once its end of the socket pair is closed, and is waited for so it is not left a zombie
+        deadline = time.monotonic() + BOT_EXIT_TIMEOUT
+        while bot_process.is_alive() and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if bot_process.is_alive():
+            bot_process.terminate()
+
+
+async def handshake(connection) -> Optional[Tuple[str, str, int]]:
+    """Read a new player's username and what they want to do, returning (username, action, room code)"""
+    username_bytes, _ = await connection.recv()
+    username = username_bytes.decode("utf-8", errors="replace")
+
+    response, _ = await connection.recv()
+    response = response.decode("utf-8", errors="replace").lower()
+
+    if not connection.connected:
+        return None
+
+    if response in ["create", "bot"]:
+        if response == "bot" and len(bot_codes) >= max_bots:
+            await connection.send(bytes("The computer is busy!", "utf-8"))
+            return None
+
+        code = rooms.new_code()
+        if code is None:
+            await connection.send(bytes("The server is full!", "utf-8"))
+            return None
+
+        return username, response, code
+    elif response in ["join", "watch"]:
         # Receive valid room code from client
-        response, _ = recv(csock)
-        response = response.decode("utf-8")
+        code, _ = await connection.recv()
+        code = code.decode("utf-8", errors="replace")
 
-        while response == "-1":
-            room_codes = [room.code for room in unfilled]
+        while code == "-1":
+            # Players join rooms waiting for them, spectators watch rooms being played
+            room_codes = rooms.unfilled_codes() if response == "join" else rooms.filled_codes()
             pickled_room_codes = pickle.dumps(room_codes)
-            send(csock, pickled_room_codes)
+            await connection.send(pickled_room_codes)
 
-            response, _ = recv(csock)
-            response = response.decode("utf-8")
+            code, _ = await connection.recv()
+            code = code.decode("utf-8", errors="replace")
 
-        for room in unfilled:
-            if int(response) == room.code:
-                room.player2 = csock
-                room.player2_username = username
+        if not connection.connected or not (code.isascii() and code.isdigit()):
+            return None
 
-                unfilled.remove(room)
-                filled.append(room)
+        return username, response, int(code)
 
-                send(room.player1, bytes("Someone has joined the room!", "utf-8"))
-                send(csock, bytes(f"Joined room!", "utf-8"))
+    return None
 
-                room_thread = threading.Thread(target=room.play)
-                room_thread.start()
 
+async def place_player(connection: Connection, username, action, code):
+    if action == "create":
+        new_room = Room(connection, code, host_username=username)
+        rooms.add(new_room)
+        new_room.wait_for_player()
+        await connection.send(bytes(f"Your room code is {code}", "utf-8"))
+    elif action == "bot":
+        new_room = Room(connection, code, host_username=username)
 
-def handle_new_connections():
-    s.listen()
+        # The computer joins through one end of a socket pair, so the room treats it like any other player.
+        # It searches in its own process, so that thinking neither blocks the event loop nor holds its GIL
+        bot_sock, room_sock = socket.socketpair()
+        bot_process = multiprocessing.get_context("spawn").Process(target=run_bot, args=(bot_sock,), daemon=True)
+        bot_process.start()
+        bot_sock.close()
 
-    while True:
-        clientsocket, address = s.accept()
-        handle_new_connection_thread = threading.Thread(target=handle_new_connection, args=(clientsocket, address))
-        handle_new_connection_thread.start()
+        bot_reader, bot_writer = await asyncio.open_connection(sock=room_sock)
+        new_room.player2 = Connection(bot_reader, bot_writer)
+        new_room.player2_username = Bot.username
+        # The computer would not be there to finish a saved game
+        new_room.logged = False
 
+        rooms.add(new_room, filled=True)
+        bot_codes.add(code)
 
-if __name__ == '__main__':
-    unfilled = []
-    filled = []
-    rooms = []
+        await connection.send(bytes("Playing against the computer!", "utf-8"))
+
+        start_task(play_against_bot(new_room, bot_process))
+    elif action == "join":
+        room = rooms.get_unfilled(code)
+        if room is None:
+            connection.close()
+            return
+
+        if room.player1 is None:
+            # The first player back in a saved game waits for the other one, just like a host
+            room.player1 = connection
+            room.player1_username = username
+            room.wait_for_player()
+            return
+
+        room.stop_waiting()
+        room.player2 = connection
+        room.player2_username = username
+        rooms.fill(code)
+
+        await room.player1.send(bytes("Someone has joined the room!", "utf-8"))
+        await connection.send(bytes(f"Joined room!", "utf-8"))
+
+        if room.saved_game is not None:
+            room.seat_saved_players()
+
+        start_task(room.play())
+    elif action == "watch":
+        room = rooms.get_filled(code)
+        if room is None or room.closed:
+            connection.close()
+            return
+
+        await connection.send(bytes("Watching room!", "utf-8"))
+        await room.watch(connection)
+
+
+async def handle_new_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    connection = Connection(reader, writer)
+    metrics.inc("chess_connections")
+    try:
+        request = await handshake(connection)
+        if request is None:
+            return
+
+        await place_player(connection, *request)
+        # From here on the connection belongs to its room, which closes it once it is done with it
+        await connection.wait_closed()
+    except asyncio.CancelledError:
+        # Only happens when the server stops. Returning rather than raising, as the stream server logs a cancelled
+        # handler as an error
+        pass
+    finally:
+        connection.close()
+        metrics.inc("chess_connections", -1)
+
+
+def report_room(code, players_missing):
+    # Keeps the front-end's lobby in step with a worker's rooms; a server running as one process has nothing to tell
+    if front_end is None:
+        return
+
+    try:
+        front_end.send(ROOM_UPDATE.pack(code, players_missing))
+    except OSError:
+        # The front-end is gone or not keeping up. Either way the worker carries on, and at worst a code stays taken
+        pass
 
-    HEADER = 64
 
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.bind(('0.0.0.0', 55555))
+def start_task(coroutine):
+    # The event loop only keeps weak references to tasks, so running ones are held here until they finish
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
 
-    handle_new_connections_thread = threading.Thread(target=handle_new_connections)
-    handle_new_connections_thread.start()
 
+def stop_on_sigterm():
+    # Set on SIGTERM, so that serving returns normally and the validation pool and game log are closed after it
+    stop = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    except NotImplementedError:  # no signal handlers in Windows event loops
+        pass
+
+    return stop
+
+
+async def report_rooms():
     while True:
-        sys.stdout.write(f"\rUnfilled Rooms: {len(unfilled)} {[room.code for room in unfilled]}; Filled Rooms: {len(filled)} {[room.code for room in filled]}")
-        time.sleep(1)
+        unfilled_codes = rooms.unfilled_codes()
+        filled_codes = rooms.filled_codes()
+        sys.stdout.write(f"\rUnfilled Rooms: {len(unfilled_codes)} {unfilled_codes}; Filled Rooms: {len(filled_codes)} {filled_codes}")
+        await asyncio.sleep(1)
+
+
+def start_game_log(options):
+    global game_log
+    if options is not None:
+        game_log = GameLog(**options)
+
+
+def resume_saved_games():
+    # Games in this process's log that never ended get their rooms back, which wait for both players to join again
+    for saved in replay([game_log.path]).values():
+        room = Room(None, saved.code)
+        room.saved_game = saved
+        rooms.add(room)
+
+    start_task(game_log.run())
+
+
+async def serve(port, metrics_port=None):
+    if game_log is not None:
+        resume_saved_games()
+
+    if metrics_port is not None:
+        start_task(serve_metrics(metrics, metrics_port))
+
+    stop = stop_on_sigterm()
+    server = await asyncio.start_server(handle_new_connection, '0.0.0.0', port, backlog=BACKLOG)
+    start_task(report_rooms())
+
+    try:
+        await stop.wait()
+    finally:
+        # Connections still open are closed when asyncio.run cancels their handlers
+        server.close()
+
+
+class RoomRecord:
+    # The front-end's view of a room that is being played in one of the workers
+    def __init__(self, code, players_missing=1):
+        self.code: int = code
+        self.players_missing = players_missing  # saved games wait for both players, new rooms only for a second one
+
+
+class Supervisor:
+    """Accepts every connection, runs the lobby, then hands each player's socket to the worker owning their room.
+
+    Rooms are sharded by code, so both players of a room always land in the same worker process
+    """
+
+    def __init__(self, num_workers, validation=None, storage=None, spectators=None, metrics_port=None):
+        self.context = multiprocessing.get_context("spawn")
+        self.spectators = spectators  # spectating settings for each worker, or None to keep the defaults
+        self.metrics_port = metrics_port  # the front-end's metrics port, with each worker's on the ports after it
+        self.validation = validation  # MoveValidator arguments for each worker, or None to check moves inline
+        self.storage = storage  # GameLog arguments, with the path each worker's log is kept next to, or None
+        self.workers = [None] * num_workers
+        self.controls = [None] * num_workers  # datagram sockets that carry handed-off sockets to each worker
+
+    def start_worker(self, shard):
+        control, worker_control = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # Not a daemon, since daemons may not start the processes of a validation pool. Workers stop by themselves
+        # once the front-end has gone, and serve terminates them when it is interrupted
+        storage = None
+        if self.storage is not None:
+            storage = dict(self.storage, path=shard_log_path(self.storage["path"], shard))
+
+        metrics_port = None
+        if self.metrics_port is not None:
+            metrics_port = self.metrics_port + 1 + shard
+
+        worker = self.context.Process(target=run_worker,
+                                      args=(worker_control, self.validation, storage, self.spectators, metrics_port))
+        worker.start()
+        worker_control.close()
+
+        self.workers[shard] = worker
+        self.controls[shard] = control
+        asyncio.get_running_loop().add_reader(control.fileno(), self.receive_room_updates, control)
+
+    def receive_room_updates(self, control: socket.socket):
+        while True:
+            try:
+                update = control.recv(ROOM_UPDATE.size, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return
+
+            code, players_missing = ROOM_UPDATE.unpack(update)
+            if players_missing == ROOM_CLOSED:
+                rooms.remove(code)
+                bot_codes.discard(code)
+            else:
+                record = rooms.get_unfilled(code)
+                if record is not None:
+                    record.players_missing = players_missing
+
+    def shard_for(self, code):
+        return code % len(self.workers)
+
+    def hand_off(self, sock: socket.socket, username, action, code):
+        request = pickle.dumps((username, action, code))
+        socket.send_fds(self.controls[self.shard_for(code)], [request], [sock.fileno()])
+
+    async def route(self, sock: socket.socket):
+        connection = SocketConnection(sock)
+        metrics.inc("chess_connections")
+        try:
+            request = await handshake(connection)
+            if request is None:
+                return
+
+            username, action, code = request
+            if action == "create":
+                rooms.add(RoomRecord(code))
+            elif action == "bot":
+                rooms.add(RoomRecord(code), filled=True)
+                bot_codes.add(code)
+            elif action == "join":
+                record = rooms.get_unfilled(code)
+                if record is None:
+                    return
+
+                record.players_missing -= 1
+                if record.players_missing == 0:
+                    rooms.fill(code)
+            elif action == "watch" and rooms.get_filled(code) is None:
+                return
+
+            self.hand_off(sock, username, action, code)
+        finally:
+            # The front-end lets go of every socket, whether or not a worker now has it
+            connection.close()
+            metrics.inc("chess_connections", -1)
+
+    async def watch_workers(self):
+        while True:
+            for shard, worker in enumerate(self.workers):
+                if not worker.is_alive():
+                    # Its rooms and their connections died with it
+                    for code in rooms.codes():
+                        if self.shard_for(code) == shard:
+                            rooms.remove(code)
+                            bot_codes.discard(code)
+
+                    asyncio.get_running_loop().remove_reader(self.controls[shard].fileno())
+                    self.controls[shard].close()
+                    self.start_worker(shard)
+
+                    # The new worker picks the games it was playing up from its log, and they wait for their players
+                    if self.storage is not None:
+                        self.add_saved_games(replay([shard_log_path(self.storage["path"], shard)]).values())
+
+            await asyncio.sleep(1)
+
+    def add_saved_games(self, saved_games):
+        for saved in saved_games:
+            rooms.add(RoomRecord(saved.code, players_missing=2))
+
+    async def serve(self, port):
+        if self.storage is not None:
+            self.add_saved_games(restore(self.storage["path"], len(self.workers)).values())
+
+        for shard in range(len(self.workers)):
+            self.start_worker(shard)
+
+        listener = socket.create_server(('0.0.0.0', port), backlog=BACKLOG)
+        listener.setblocking(False)
+
+        start_task(self.watch_workers())
+        start_task(report_rooms())
+        if self.metrics_port is not None:
+            start_task(serve_metrics(metrics, self.metrics_port))
+
+        stop = stop_on_sigterm()
+        accepting = asyncio.create_task(self.accept(listener))
+        try:
+            await stop.wait()
+        finally:
+            accepting.cancel()
+            listener.close()
+            for worker in self.workers:
+                worker.terminate()
+
+    async def accept(self, listener: socket.socket):
+        loop = asyncio.get_running_loop()
+        while True:
+            sock, _ = await loop.sock_accept(listener)
+            start_task(self.route(sock))
+
+
+def start_validation(options):
+    global validator
+    if options is not None:
+        validator = MoveValidator(**options)
+
+
+def start_spectating(options):
+    if options is not None:
+        spectating.update(options)
+
+
+def run_worker(control: socket.socket, validation=None, storage=None, spectators=None, metrics_port=None):
+    raise_open_file_limit()
+    start_validation(validation)
+    start_game_log(storage)
+    start_spectating(spectators)
+    try:
+        asyncio.run(serve_shard(control, metrics_port))
+    finally:
+        if validator is not None:
+            validator.close()
+        if game_log is not None:
+            game_log.close()
+
+
+async def serve_shard(control: socket.socket, metrics_port=None):
+    global front_end
+    loop = asyncio.get_running_loop()
+    control.setblocking(False)
+    front_end = control
+
+    if metrics_port is not None:
+        start_task(serve_metrics(metrics, metrics_port))
+
+    def receive_handoff():
+        try:
+            request, fds, _, _ = socket.recv_fds(control, HANDOFF_SIZE, 1)
+        except BlockingIOError:
+            return
+
+        if fds:
+            start_task(adopt_player(fds[0], *pickle.loads(request)))
+
+    loop.add_reader(control.fileno(), receive_handoff)
+
+    if game_log is not None:
+        resume_saved_games()
+
+    # terminate() from the front-end stops the shard, and so does the front-end going away without it: datagram
+    # sockets never report that the other end closed, so the front-end process itself is watched
+    stop = stop_on_sigterm()
+    parent = multiprocessing.parent_process()
+    while parent.is_alive():
+        try:
+            await asyncio.wait_for(stop.wait(), 1)
+            break
+        except asyncio.TimeoutError:
+            pass
+
+
+async def adopt_player(fd, username, action, code):
+    reader, writer = await asyncio.open_connection(sock=socket.socket(fileno=fd))
+    connection = Connection(reader, writer)
+    metrics.inc("chess_connections")
+    try:
+        await place_player(connection, username, action, code)
+        await connection.wait_closed()
+    finally:
+        connection.close()
+        metrics.inc("chess_connections", -1)
+
+
+def raise_open_file_limit():
+    # Every connection is a file descriptor, and the usual soft limit of 1024 is far below what one event loop can serve
+    try:
+        import resource
+    except ImportError:  # not available on Windows
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        # some systems report an unlimited hard limit that cannot actually be set
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Chess server")
+    parser.add_argument("--port", type=int, default=55555, help="port to listen on")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes to shard rooms across; with 1 everything runs in this process")
+    parser.add_argument("--validation-workers", type=int, default=0,
+                        help="processes per server process that find the legal moves after each move; with 0 this is done inline")
+    parser.add_argument("--validation-queue", type=int, default=256,
+                        help="most moves waiting in the validation pool before more are handled inline")
+    parser.add_argument("--validation-timeout", type=float, default=1.0,
+                        help="seconds to wait for the validation pool before handling a move inline")
+    parser.add_argument("--game-log", help="file to save games in, so that they can be finished after a restart")
+    parser.add_argument("--game-log-interval", type=float, default=1.0,
+                        help="seconds between writes of the game log to disk")
+    parser.add_argument("--spectator-buffer", type=int, default=64,
+                        help="most messages waiting to be sent to a spectator before it counts as fallen behind")
+    parser.add_argument("--spectator-overflow", choices=["resync", "disconnect"], default="resync",
+                        help="what to do with a spectator that has fallen behind: send it the whole game again, or drop it")
+    parser.add_argument("--max-bots", type=int, default=4,
+                        help="most games against the computer at once, each of which keeps a CPU busy while it thinks")
+    parser.add_argument("--metrics-port", type=int,
+                        help="local port to serve Prometheus metrics on at /metrics; workers use the ports after it")
+    args = parser.parse_args()
+
+    global max_bots
+    max_bots = args.max_bots
+    raise_open_file_limit()
+
+    validation = None
+    if args.validation_workers > 0:
+        validation = {"workers": args.validation_workers, "max_pending": args.validation_queue, "timeout": args.validation_timeout}
+
+    storage = None
+    if args.game_log:
+        storage = {"path": args.game_log, "interval": args.game_log_interval}
+
+    spectators = {"max_frames": args.spectator_buffer, "overflow": args.spectator_overflow}
+
+    if args.workers > 1 and not hasattr(socket, "send_fds"):
+        print("Passing sockets between processes is not supported here, so running a single process")
+        args.workers = 1
+
+    if args.workers > 1:
+        asyncio.run(Supervisor(args.workers, validation, storage, spectators, args.metrics_port).serve(args.port))
+    else:
+        start_validation(validation)
+        start_spectating(spectators)
+        if storage is not None:
+            restore(storage["path"])
+        start_game_log(storage)
+        try:
+            asyncio.run(serve(args.port, args.metrics_port))
+        finally:
+            if validator is not None:
+                validator.close()
+            if game_log is not None:
+                game_log.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+import asyncio
+import glob
+import json
+import os
+import struct
+
+from model import *
+
+# Every record: type, room code, number of moves played including this one, packed move, length of the text after it
+RECORD = struct.Struct("!BIIHI")
+
+START_RECORD = 1  # text is JSON [starting FEN, white username, black username]
+MOVE_RECORD = 2
+SNAPSHOT_RECORD = 3  # text is the FEN after the move of the same number
+END_RECORD = 4
+
+
+class SavedGame:
+    # A game that was still being played when its log ends
+    def __init__(self, code, fen, white_username, black_username):
+        self.code: int = code
+        self.white_username = white_username
+        self.black_username = black_username
+        self.fen = fen  # latest position written out in full
+        self.sequence = 0  # moves played up to fen
+        self.moves = []  # packed moves played since fen
+
+    def position(self):
+        # FEN of the position the game had reached
+        if not self.moves:
+            return self.fen
+
+        game = Game.from_fen(self.fen)
+        for packed in self.moves:
+            game.make_packed_move(packed)
+
+        return game.to_fen()
+
+
+def encode_record(record_type, code, sequence=0, packed=0, text=""):
+    text_bytes = bytes(text, "utf-8")
+    return RECORD.pack(record_type, code, sequence, packed, len(text_bytes)) + text_bytes
+
+
+def read_records(path):
+    """Yield (type, room code, sequence, packed move, text) for each record in the log at path.
+
+    A record cut short by a crash ends the log, since nothing after it was ever acknowledged
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+
+    offset = 0
+    while offset + RECORD.size <= len(data):
+        record_type, code, sequence, packed, text_length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if offset + text_length > len(data):
+            break
+
+        yield record_type, code, sequence, packed, data[offset:offset + text_length].decode("utf-8")
+        offset += text_length
+
+
+def replay(paths):
+    """Read the logs at paths in order, returning {room code: SavedGame} for the games that never ended"""
+    saved_games = {}
+    for path in paths:
+        for record_type, code, sequence, packed, text in read_records(path):
+            if record_type == START_RECORD:
+                fen, white_username, black_username = json.loads(text)
+                saved_games[code] = SavedGame(code, fen, white_username, black_username)
+            elif code not in saved_games:
+                continue
+            elif record_type == MOVE_RECORD:
+                saved = saved_games[code]
+                if sequence == saved.sequence + len(saved.moves) + 1:
+                    saved.moves.append(packed)
+            elif record_type == SNAPSHOT_RECORD:
+                saved = saved_games[code]
+                saved.fen = text
+                saved.sequence = sequence
+                saved.moves = []
+            elif record_type == END_RECORD:
+                del saved_games[code]
+
+    return saved_games
+
+
+def write_log(path, saved_games):
+    """Replace the log at path with one that starts each saved game from its current position"""
+    temporary_path = path + ".new"
+    with open(temporary_path, "wb") as file:
+        for saved in saved_games:
+            text = json.dumps([saved.position(), saved.white_username, saved.black_username])
+            file.write(encode_record(START_RECORD, saved.code, text=text))
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(temporary_path, path)
+
+
+def shard_log_path(path, shard):
+    return f"{path}.{shard}"
+
+
+def existing_log_paths(path):
+    # The log of a server running as one process, and those of the workers of a sharded one
+    paths = [path] if os.path.exists(path) else []
+    for shard_path in sorted(glob.glob(glob.escape(path) + ".*")):
+        if shard_path[len(path) + 1:].isdigit():
+            paths.append(shard_path)
+
+    return paths
+
+
+def restore(path, shards=1):
+    """Replay the logs kept at path and compact the games that never ended into one log for each of shards processes,
+    returning {room code: SavedGame}. Must run before any GameLog opens those logs
+    """
+    old_paths = existing_log_paths(path)
+    saved_games = replay(old_paths)
+
+    new_paths = [path] if shards == 1 else [shard_log_path(path, shard) for shard in range(shards)]
+    for shard, new_path in enumerate(new_paths):
+        # Games go to the process owning their room, which is picked by room code
+        write_log(new_path, [saved for saved in saved_games.values() if saved.code % shards == shard])
+
+    for old_path in old_paths:
+        if old_path not in new_paths:
+            os.remove(old_path)
+
+    return saved_games
+
+
+class GameLog:
+    """Append-only log of the games being played, so that they can be picked up again after a restart.
+
+    Records are buffered and written out together every interval seconds, with the write and fsync done off the event
+    loop, so that moves never wait on the disk. Whatever is buffered when the server dies is lost
+    """
+
+    def __init__(self, path, interval=1.0):
+        self.path = path
+        self.interval = interval
+        self.pending = bytearray()
+        self.file = open(path, "ab")
+
+    def start_game(self, code, game: Game, white_username, black_username):
+        self.pending += encode_record(START_RECORD, code, text=json.dumps([game.to_fen(), white_username, black_username]))
+
+    def record_move(self, code, sequence, packed, snapshot=""):
+        self.pending += encode_record(MOVE_RECORD, code, sequence, packed)
+        if snapshot:
+            self.pending += encode_record(SNAPSHOT_RECORD, code, sequence, text=snapshot)
+
+    def end_game(self, code):
+        self.pending += encode_record(END_RECORD, code)
+
+    def write(self, data):
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.pending:
+                # Swap the buffer here, so records added while the disk is busy go in the next batch
+                data, self.pending = self.pending, bytearray()
+                await loop.run_in_executor(None, self.write, data)
+
+    def close(self):
+        if self.pending:
+            self.write(self.pending)
+            self.pending = bytearray()
+        self.file.close()
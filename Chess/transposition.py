@@ -0,0 +1,61 @@
+from array import array
+
+EXACT = 1
+LOWER_BOUND = 2
+UPPER_BOUND = 3
+
+# Each slot is two 64-bit words: the full position key, then the packed data below
+# bits 0-7 depth, 8-9 bound, 10-15 search age, 16-47 score (offset by 2 ** 31), 48-63 best move as a packed move (0 for none)
+SLOT_WORDS = 2
+BUCKET_SLOTS = 2  # slot 0 keeps the deepest entry, slot 1 always takes the newest one
+BUCKET_BYTES = SLOT_WORDS * BUCKET_SLOTS * 8
+SCORE_OFFSET = 1 << 31
+
+
+class TranspositionTable:
+    def __init__(self, size_mb=16):
+        # Round down to a power of two buckets so the bucket index is a mask of the key
+        buckets = max(1, size_mb * 1024 * 1024 // BUCKET_BYTES)
+        self.buckets = 1 << (buckets.bit_length() - 1)
+        self.mask = self.buckets - 1
+        self.slots = array('Q', [0]) * (self.buckets * BUCKET_SLOTS * SLOT_WORDS)
+        self.age = 0
+
+    @property
+    def size_bytes(self):
+        return self.slots.itemsize * len(self.slots)
+
+    def new_search(self):
+        self.age = (self.age + 1) & 63
+
+    def clear(self):
+        self.slots = array('Q', [0]) * len(self.slots)
+        self.age = 0
+
+    def probe(self, key):
+        slots = self.slots
+        base = (key & self.mask) * BUCKET_SLOTS * SLOT_WORDS
+        for offset in range(0, BUCKET_SLOTS * SLOT_WORDS, SLOT_WORDS):
+            if slots[base + offset] == key:
+                data = slots[base + offset + 1]
+                if data:
+                    return data & 0xFF, data >> 8 & 3, (data >> 16 & 0xFFFFFFFF) - SCORE_OFFSET, data >> 48
+
+        return None
+
+    def store(self, key, depth, score, bound, move=0):
+        slots = self.slots
+        base = (key & self.mask) * BUCKET_SLOTS * SLOT_WORDS
+        data = min(depth, 255) | bound << 8 | self.age << 10 | (score + SCORE_OFFSET) << 16 | move << 48
+
+        deep_data = slots[base + 1]
+        if slots[base] == key or deep_data == 0 or depth >= deep_data & 0xFF or deep_data >> 10 & 63 != self.age:
+            # Keep the old best move when a shallower search of the same position did not find one
+            if slots[base] == key and move == 0:
+                data |= deep_data >> 48 << 48
+            slots[base] = key
+            slots[base + 1] = data
+        else:
+            slots[base + 2] = key
+            slots[base + 3] = data
+